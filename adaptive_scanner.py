@@ -0,0 +1,301 @@
+from typing import Callable, Union
+import numpy as np
+import numpy.typing as npt
+from itertools import product
+from numbers import Number
+from pathlib import Path
+from warnings import warn
+from scanner import Scanner, _safe_file_name
+
+def _score_gradient(corners : npt.NDArray) -> float:
+    return np.ptp(corners)
+
+def _score_signal(corners : npt.NDArray) -> float:
+    return np.max(corners)
+
+class AdaptiveScanner():
+    """Class for running a function over a grid, starting from a coarse grid, and
+       only refining the cells of the grid where something interesting is happening.
+       Every refinement level halves the spacing between points in the selected cells,
+       so after `levels` levels, they are sampled with the same resolution as a full
+       grid with `(coarse_steps - 1) * 2**levels + 1` steps along each axis.
+       Cells are refined based on a score computed from the values at their corners,
+       either how much the values change across the cell ('gradient'), or how large they
+       are ('signal'). The total number of points measured then depends on how much
+       of the scan area contains features, rather than on the area itself.
+
+       The coarse grid is run with a `Scanner`, so the same function signatures apply.
+       Since results need to be compared and interpolated, the function must return a
+       single number at every point. Features smaller than the coarse grid spacing
+       can be missed entirely, so the coarse grid should still resolve where features are.
+
+        Parameters (for __init__)
+        ----------
+        function : Callable
+            The function to be called at each point, must only take in the swept
+            parameters as input and return a single number, see `Scanner`.
+        centers : list[Number]
+            The central values of each parameter sweep.
+        spans : list[Number]
+            The size of the range to sweep over each parameter.
+        coarse_steps : list[int]
+            How many steps to take along each axis for the initial coarse grid.
+        levels : int, optional
+            How many times to refine interesting cells, by default 2.
+        snake : list[int], optional
+            Which axes of the coarse grid should be snaked, see `Scanner`. By default []
+        labels : list[], optional
+            A list of labels to call each axis of the sweep, see `Scanner`. By default None.
+        score : str | Callable, optional
+            How to score cells, either 'gradient', 'signal', or a function taking the array
+            of results at the corners of a cell and returning its score. By default 'gradient'.
+        threshold : float, optional
+            Cells are refined if their score is above this fraction of the highest
+            score of the coarse grid cells, by default 0.1.
+        init : Callable, optional
+            Run once before starting the sweep, see `Scanner`.
+        abort : Callable, optional
+            Checked after every point, see `Scanner`. Since the total number of points isn't
+            known ahead of time, Imax is the number of points planned so far, and the index is
+            the index in the fully refined grid.
+        progress : Callable, optional
+            Run after every point, see `Scanner`, with the same caveats as `abort`.
+        finish : Callable, optional
+            Run once after the sweep finishes, see `Scanner`. Receives the
+            interpolated dense results from `dense()`.
+    """
+    def __init__(self, function : Callable,
+                 centers : list[Number], spans: list[Number], coarse_steps : list[int],
+                 levels : int = 2,
+                 snake : list[int] = [],
+                 labels : list[object] = None,
+                 score : Union[str, Callable] = 'gradient',
+                 threshold : float = 0.1,
+                 init:Callable = lambda *args: None,
+                 abort:Callable = lambda *args: False,
+                 progress:Callable = lambda *args: None,
+                 finish:Callable= lambda *args: None) -> None:
+        # Let the scanner check the parameters and functions make sense.
+        self._scanner = Scanner(function, centers, spans, coarse_steps, snake, [], float,
+                                labels, init, abort, progress, finish)
+        score_funcs = {'gradient' : _score_gradient, 'signal' : _score_signal}
+        if isinstance(score, str):
+            if score not in score_funcs.keys():
+                raise RuntimeError(f"Invalid score: {score}")
+            score = score_funcs[score]
+        if levels < 0:
+            raise RuntimeError("Number of levels can't be negative.")
+
+        self._func = function
+        self._score_func = score
+        self._levels = int(levels)
+        self.threshold = threshold
+        self.labels = self._scanner.labels
+        self._init_func = init
+        self._abort_func = abort
+        self._prog_func = progress
+        self._finish_func = finish
+
+        self._has_run = False
+
+    @property
+    def steps(self) -> list[int]:
+        """Get the number of steps along each axis of the fully refined grid.
+
+        Returns
+        -------
+        list[int]
+            A list where each value is that axis' number of steps.
+        """
+        return [int(n - 1) * 2**self._levels + 1 for n in self._scanner.steps]
+
+    @property
+    def positions(self) -> list[npt.NDArray]:
+        """Get the positions along each axis of the fully refined grid.
+
+        Returns
+        -------
+        list[numpy.ndarray]
+            A list where each value is that axis' numpy array of positions.
+        """
+        return [np.linspace(center - span/2, center + span/2, n) for center, span, n
+                in zip(self._scanner.centers, self._scanner.spans, self.steps)]
+
+    def run(self):
+        """Run the sweep. First the coarse grid is swept, then every cell whose score is above
+        the threshold is split in two along each axis, and the new points at the corners
+        of the smaller cells are measured, which is then repeated for every level.
+        Once the sweep is completed the provided finish function is run, and finally the
+        interpolated dense results are returned.
+
+        Returns
+        -------
+        np.ndarray[float]
+            The dense results, see `dense()`.
+        """
+        n_dim = len(self._scanner.steps)
+        size = 2**self._levels
+        self._grid_positions = self.positions
+        self.values = np.full(self.steps, np.nan)
+        self.measured = np.zeros(self.steps, dtype=bool)
+        self._leaves = []
+        self._n = 0
+        self._planned = self._scanner.n_steps
+        self._aborted = False
+        self._has_run = True
+        completed = False
+
+        # Run the coarse grid through a Scanner, placing points on the refined grid.
+        def coarse_abort(I, Imax, index, position, result):
+            return self._record(tuple(i * size for i in index), position, result)
+        def coarse_finish(results, coarse_completed):
+            nonlocal completed
+            completed = coarse_completed
+        self._scanner._init_func = self._init_func
+        self._scanner._abort_func = coarse_abort
+        self._scanner._prog_func = lambda *args: None
+        self._scanner._finish_func = coarse_finish
+        self._scanner.run()
+
+        cells = [tuple(i * size for i in index)
+                 for index in np.ndindex(*[n - 1 for n in self._scanner.steps])]
+        scores = [self._score(cell, size) for cell in cells]
+        threshold = self.threshold * np.nanmax(scores) if cells else 0
+
+        try:
+            while completed and size > 1 and cells:
+                refine = []
+                for cell, score in zip(cells, scores):
+                    if score > threshold:
+                        refine.append(cell)
+                    else:
+                        self._leaves.append((cell, size))
+                half = size // 2
+                new = {tuple(c + o * half for c, o in zip(cell, offset))
+                       for cell in refine for offset in product((0, 1, 2), repeat=n_dim)}
+                new = sorted(index for index in new if not self.measured[index])
+                self._planned += len(new)
+                for index in new:
+                    position = tuple(self._grid_positions[ax][i] for ax, i in enumerate(index))
+                    if self._record(index, position, self._func(*position)):
+                        break
+                if self._aborted:
+                    break
+                cells = [tuple(c + o * half for c, o in zip(cell, offset))
+                         for cell in refine for offset in product((0, 1), repeat=n_dim)]
+                size = half
+                scores = [self._score(cell, size) for cell in cells]
+        except KeyboardInterrupt:
+            warn("Caught Keyboard Intterup, aborting scan.")
+            completed = False
+        self._leaves += [(cell, size) for cell in cells]
+
+        dense = self.dense()
+        if not self._aborted:
+            self._finish_func(dense, completed)
+        return dense
+
+    def _record(self, index : tuple[int], position : tuple[Number], result : float) -> bool:
+        """Save the result at a point of the refined grid, and run the abort and
+           progress functions.
+
+        Returns
+        -------
+        bool
+            Whether the abort function requested to stop the scan.
+        """
+        self.values[index] = result
+        self.measured[index] = True
+        I = self._n
+        self._n += 1
+        if self._abort_func(I, self._planned, index, position, result):
+            self._aborted = True
+            return True
+        self._prog_func(I, self._planned, index, position, result)
+        return False
+
+    def _corners(self, cell : tuple[int], size : int) -> npt.NDArray:
+        """Get the results at every corner of a cell, given its lowest corner and size."""
+        return np.array([self.values[tuple(c + o * size for c, o in zip(cell, offset))]
+                         for offset in product((0, 1), repeat=len(cell))])
+
+    def _score(self, cell : tuple[int], size : int) -> float:
+        corners = self._corners(cell, size)
+        if np.any(np.isnan(corners)):
+            return -np.inf
+        return self._score_func(corners)
+
+    def dense(self) -> npt.NDArray:
+        """Get the results over the fully refined grid. Points that weren't measured
+           are filled in by multilinear interpolation of the corners of the smallest
+           cell containing them, and left as nan if that cell wasn't fully measured.
+
+        Returns
+        -------
+        np.ndarray[float]
+            The dense results, shaped like `steps`.
+        """
+        if not self._has_run:
+            raise RuntimeError("Scan must be run before getting results")
+        dense = np.copy(self.values)
+        for cell, size in self._leaves:
+            corners = self._corners(cell, size)
+            if np.any(np.isnan(corners)):
+                continue
+            t = np.linspace(0, 1, size + 1)
+            interp = 0
+            for corner, offset in zip(corners, product((0, 1), repeat=len(cell))):
+                weight = 1
+                for ax, o in enumerate(offset):
+                    shape = [1] * len(cell)
+                    shape[ax] = size + 1
+                    weight = weight * (t if o else 1 - t).reshape(shape)
+                interp = interp + corner * weight
+            block = tuple(slice(c, c + size + 1) for c in cell)
+            unmeasured = ~self.measured[block]
+            dense[block][unmeasured] = interp[unmeasured]
+        return dense
+
+    def samples(self) -> tuple[npt.NDArray, npt.NDArray]:
+        """Get the points that were actually measured.
+
+        Returns
+        -------
+        np.ndarray[float]
+            The (N, n_axes) array of positions of every measured point.
+        np.ndarray[float]
+            The N results at those points.
+        """
+        if not self._has_run:
+            raise RuntimeError("Scan must be run before getting results")
+        indices = np.argwhere(self.measured)
+        points = np.stack([self._grid_positions[ax][indices[:,ax]]
+                           for ax in range(indices.shape[1])], axis=-1)
+        return points, self.values[self.measured]
+
+    def save_results(self, filename : str, header : str = ""):
+        """Saves the results from the most recent run as a binary numpy array archive,
+        containing the measured points and results as 'points' and 'values',
+        as well as the interpolated dense results and grid positions as 'res' and 'pos'
+        like `Scanner.save_results`.
+
+        Parameters
+        ----------
+        filename : str
+            The path to the file to be saved, without an extension.
+            The path will be checked for an existing file with the same name, in which
+            case a number will be appended to avoid conflicts.
+        header : str, optional
+            Additional data to be saved with the file, as an array named 'head'.
+            By default ""
+        """
+        if isinstance(filename, str):
+            filename = Path(filename)
+        filename = _safe_file_name(filename)
+        points, values = self.samples()
+        np.savez(filename, res=self.dense(),
+                           pos=np.array(self._grid_positions, dtype=object),
+                           points=points,
+                           values=values,
+                           labels=np.array(self.labels),
+                           head=np.array(header))
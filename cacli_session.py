@@ -0,0 +1,75 @@
+import subprocess
+import logging
+from collections import deque
+from threading import Lock
+from time import perf_counter
+
+log = logging.getLogger("stepper")
+
+# Don't flash up a console window for every command on windows.
+_creationflags = getattr(subprocess, "CREATE_NO_WINDOW", 0)
+
+class CacliSession():
+    """Channel through which cacli commands are sent, shared by every command of a stepper.
+       Each request is a list of arguments, run as `argv + request` in its own cacli process,
+       and the response is the bytes written to stdout by cacli. Every request has a timeout,
+       so a stuck cacli can't hang the stage control forever.
+
+        Parameters (for __init__)
+        ----------
+        argv : list[str]
+            The executable and any arguments preceding every command,
+            e.g. `[exe, "@SERV:<serial>"]`.
+        timeout : float, optional
+            How long to wait for a response in s, by default 10.
+    """
+    _n_latencies = 1000
+
+    def __init__(self, argv : list[str], timeout : float = 10.0) -> None:
+        self.argv = [str(arg) for arg in argv]
+        self.timeout = timeout
+
+        self._lock = Lock()
+        self.latencies = deque(maxlen=self._n_latencies)
+
+    def request(self, args : list[str], timeout : float = None) -> bytes:
+        """Send a command and wait for its response.
+
+        Parameters
+        ----------
+        args : list[str]
+            The command and its arguments.
+        timeout : float, optional
+            How long to wait for this response in s, by default the session's timeout.
+
+        Returns
+        -------
+        bytes
+            Everything cacli wrote to stdout in response.
+
+        Raises
+        ------
+        TimeoutError
+            If cacli didn't respond within the timeout.
+        """
+        args = [str(arg) for arg in args]
+        if timeout is None:
+            timeout = self.timeout
+        with self._lock:
+            start = perf_counter()
+            try:
+                res = subprocess.run(self.argv + args, capture_output=True, stdin=subprocess.DEVNULL,
+                                     timeout=timeout, creationflags=_creationflags)
+            except subprocess.TimeoutExpired:
+                log.warning(f"cacli {' '.join(args)} got no response within {timeout}s.")
+                raise TimeoutError(f"No response from cacli within {timeout}s.")
+            self.latencies.append(perf_counter() - start)
+            return res.stdout
+
+    def stats(self) -> dict[str, float]:
+        """Number of requests, mean and max latency in s of the most recent requests."""
+        stats = {"n" : len(self.latencies)}
+        if self.latencies:
+            stats["mean"] = sum(self.latencies) / len(self.latencies)
+            stats["max"] = max(self.latencies)
+        return stats
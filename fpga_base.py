@@ -4,22 +4,36 @@
 """
 
 import numpy as np
-from nifpga.session import Session
+try:
+    from nifpga.session import Session
+    from nifpga.status import FifoTimeoutError
+except ImportError:
+    # Only a simulated session can be used, see fpga_sim.py
+    Session = None
+    FifoTimeoutError = TimeoutError
 
 # Functions for converting between fpga bits and volts
+# Both work elementwise on arrays, returning a scalar for a scalar input.
 def _volts_to_bits(voltage, vmax, bit_depth):
-    if np.abs(voltage) > vmax:
+    voltage = np.asarray(voltage, dtype=float)
+    if not np.all(np.isfinite(voltage)):
+        raise ValueError("Given voltage is not a finite number.")
+    if np.any(np.abs(voltage) > vmax):
         raise ValueError("Given voltage outside of given max voltage.")
-    if voltage == vmax:
-        return 2**(bit_depth - 1) - 1
-    return int(np.round(voltage/vmax * (2**(bit_depth-1)-1) + (0.5 if voltage > 0 else -0.5)))
+    top = 2**(bit_depth - 1) - 1
+    bits = np.round(voltage/vmax * top + np.where(voltage > 0, 0.5, -0.5)).astype(np.int64)
+    bits = np.where(voltage == vmax, top, bits)
+    if bits.ndim == 0:
+        return int(bits)
+    return bits
 
 def _bits_to_volts(bits, vmax, bit_depth):
-    if np.abs(bits) > 2**(bit_depth-1):
+    bits = np.asarray(bits, dtype=np.int64)
+    if np.any(np.abs(bits) > 2**(bit_depth-1)):
         raise ValueError("Given int outside binary depth range.")
-    if bits == -2**(bit_depth-1):
-        return -vmax
-    return (bits - (0.5 * np.sign(bits))) / (2**(bit_depth-1) - 1) * vmax
+    volts = (bits - (0.5 * np.sign(bits))) / (2**(bit_depth-1) - 1) * vmax
+    volts = np.where(bits == -2**(bit_depth-1), -vmax, volts)
+    return volts[()]
 
 def _within(value,vmin,vmax):
     """Check that a value is within a certain range.     
@@ -54,7 +68,9 @@ class NiFPGA():
     _vmax = 10
     _bit_depth = 16
 
-    def __init__(self, **kwargs):
+    def __init__(self, session=None, **kwargs):
+        # Session to use instead of opening one on the hardware, e.g. a fpga_sim.SimSession
+        self._session = session
         self._max_voltage_range = np.array([-10.0,10.0],dtype=np.double)
         self._clock_frequency = 120E6
         self._voltage_ranges = np.tile(self._max_voltage_range, [self._n_AO,1])
@@ -62,13 +78,32 @@ class NiFPGA():
     def on_activate(self):
         """ Initialisation performed during activation of the module.
         """
+        if self._session is not None:
+            self._fpga = self._session
+            self._cache_handles()
+            return
         # Open the session with the FPGA card
         print("Opening fpga session")
+        if Session is None:
+            raise ImportError("nifpga is required to open a session with the fpga.")
         try:
             self._fpga = Session(bitfile=self._bitfile_path, resource=self._resource_num)
         except:
             print("Couldn't create fpga session")
             raise
+        self._cache_handles()
+
+    def _cache_handles(self):
+        """ Look up every register and fifo once, and keep a shadow copy of the
+            analog output bits, so setting and getting them doesn't need to
+            look up or read the registers each time. The AI registers are only
+            looked up on the first `get_AI_volts`, so nothing else depends on them.
+        """
+        self._registers = dict(self._fpga.registers)
+        self._fifos = dict(self._fpga.fifos)
+        self._ao_registers = [self._registers[f"AO{chn}"] for chn in range(self._n_AO)]
+        self._ai_registers = None
+        self._ao_bits = [register.read() for register in self._ao_registers]
 
     def reset_hardware(self):
         """ Resets the hardware, so the connection is lost and other programs
@@ -77,8 +112,8 @@ class NiFPGA():
         @return int: error code (0:OK, -1:error)
         """
         try:
-            for fifo in self._fpga.fifos.keys():
-                self._fpga.fifos[fifo].stop()
+            for fifo in self._fifos.values():
+                fifo.stop()
             self._fpga.reset()
             self._fpga.close()
         except:
@@ -89,33 +124,77 @@ class NiFPGA():
     # Register Methods
     def read_register(self, name):
         try:
-            return self._fpga.registers[name].read()
+            return self._registers[name].read()
         except:
             raise
 
     def write_register(self, name, value):
         try:
-            return self._fpga.registers[name].write(value)
+            return self._registers[name].write(value)
         except:
             raise
     
     # Fifo Methods
-    def read_fifo(self, name, n_elem=None):
+    def read_fifo(self, name, n_elem=None, timeout=0):
+        """ Read `n_elem` elements from a fifo, or all available elements if None.
+            If `timeout` (in ms) is given, blocks until the elements are available,
+            raising TimeoutError if they don't arrive in time.
+        """
+        fifo = self._fifos[name]
         if n_elem is None:
-            n_elem = self._fpga.fifos[name].read(0).elements_remaining
-        return np.fromiter(self._fpga.fifos[name].read(n_elem).data, dtype=np.uint32, count=n_elem)
+            n_elem = fifo.read(0).elements_remaining
+        out = np.empty(n_elem, dtype=np.uint32)
+        if n_elem == 0:
+            return out
+        self._read_into(name, out, timeout)
+        return out
+
+    def read_fifo_into(self, name, out, timeout=0):
+        """ Read `len(out)` elements from a fifo into the preallocated uint32 array `out`,
+            blocking up to `timeout` ms like `read_fifo`, so nothing is allocated per read.
+
+        @return int: the number of elements left in the fifo.
+        """
+        if out.dtype != np.uint32 or not out.flags.c_contiguous:
+            raise ValueError("Fifo reads need a contiguous uint32 array.")
+        return self._read_into(name, out, timeout)
+
+    def drain_fifo(self, name, out, remaining=None):
+        """ Read everything available in a fifo, in blocks of up to `len(out)` elements,
+            yielding a view of `out` holding each block. Each block must be used before
+            asking for the next, since they share the same memory. The fifo is only
+            checked once for how many elements it holds, unless `remaining` is already known.
+        """
+        if remaining is None:
+            remaining = self._fifos[name].read(0).elements_remaining
+        while remaining > 0:
+            block = out[:min(remaining, len(out))]
+            remaining = self.read_fifo_into(name, block)
+            yield block
+
+    def _read_into(self, name, out, timeout):
+        try:
+            values = self._fifos[name].read(len(out), timeout)
+        except FifoTimeoutError:
+            raise TimeoutError(f"Timed out reading {len(out)} elements from {name}.")
+        try:
+            # The driver returns a ctypes array, which can be viewed without copying
+            out[:] = np.ctypeslib.as_array(values.data)
+        except (TypeError, ValueError):
+            out[:] = np.fromiter(values.data, dtype=np.uint32, count=len(out))
+        return values.elements_remaining
 
     def write_fifo(self, name, data,timeout=5000):
         try:
-            self._fpga.fifos[name].write(data,timeout)
+            self._fifos[name].write(data,timeout)
         except:
             raise
 
     def set_size_fifo(self, name, size):
-        return self._fpga.fifos[name].configure(size)
+        return self._fifos[name].configure(size)
 
     def stop_fifo(self, name):
-        self._fpga.fifos[name].stop()
+        self._fifos[name].stop()
 
                         #################
                         #               #
@@ -158,6 +237,20 @@ class NiFPGA():
             return self._voltage_ranges
         return self._voltage_ranges[index]
 
+    def check_AO_volts(self, chns, vs):
+        """ Check that voltages are within the range of their AOs.
+            `vs` can have any number of leading dimensions, e.g. one row of
+            voltages per point of a scan, with the last one matching `chns`.
+        """
+        vs = np.asarray(vs, dtype=float)
+        vranges = self.get_AO_range(chns).reshape(-1, 2)
+        # Written so that nan is outside of every range
+        outside = ~((vs >= vranges[:,0]) & (vs <= vranges[:,1]))
+        if np.any(outside):
+            idx = tuple(np.argwhere(outside)[0])
+            i = idx[-1]
+            raise ValueError(f"Given voltage {vs[idx]} outside range {vranges[i]} on chn {np.atleast_1d(chns)[i]}")
+
     def set_AO_volts(self, chns: float, vs: float):
         """Move galvo to x, y.
 
@@ -166,31 +259,43 @@ class NiFPGA():
 
         @return int: error code (0:OK, -1:error)
         """
-        vranges = self.get_AO_range(chns)
-        for i,(v,vrange) in enumerate(zip(vs,vranges)):
-            if not _within(v,*vrange):
-                raise ValueError(f"Given voltage {v} outside range {vrange} on chn {chns[i]}")
-        for chn,v in zip(chns,vs):
-            try:
-                self._fpga.registers[f"AO{chn}"].write(_volts_to_bits(v,self._vmax,self._bit_depth))
-            except:
-                raise
+        self.check_AO_volts(chns, vs)
+        bits = _volts_to_bits(vs, self._vmax, self._bit_depth)
+        for chn,bit in zip(chns,bits.tolist()):
+            self.write_AO_bits(chn, bit)
+
+    def write_AO_bits(self, chn, bits):
+        """ Write the raw bits of an AO, keeping track of them in the shadow copy.
+        """
+        try:
+            self._ao_registers[chn].write(bits)
+        except:
+            raise
+        self._ao_bits[chn] = bits
 
     def get_AO_volts(self,chns=None):
         """ Get the current position of the scanner hardware.
+            Uses the last values written, which are kept track of, rather than reading
+            the registers, see `read_AO_volts`.
 
         @return float[n]: current position in (z1,z2,z3).
         """
+        if chns is None:
+            chns = list(range(self._n_AO))
+        return list(_bits_to_volts([self._ao_bits[chn] for chn in chns],
+                                   self._vmax, self._bit_depth))
+
+    def read_AO_volts(self,chns=None):
+        """ Read the AO voltages from the fpga, updating the shadow copy.
+        """
         if chns is None:
             chns = list(range(self._n_AO))
         try:
-            volts = [_bits_to_volts(self._fpga.registers[f"AO{chn}"].read(),
-                                    self._vmax, self._bit_depth) 
-                     for chn in chns]
+            for chn in chns:
+                self._ao_bits[chn] = self._ao_registers[chn].read()
         except:
             raise
-
-        return volts
+        return self.get_AO_volts(chns)
         """try:
         self._fpga.registers['Start FPGA 1'].write(0)
         self._fpga.registers[self._x_channel].write(_volts_to_bits(x))
@@ -231,12 +336,13 @@ class NiFPGA():
         """
         if chns is None:
             chns = list(range(self._n_AI))
+        if self._ai_registers is None:
+            self._ai_registers = [self._registers[f"AI{chn}"] for chn in range(self._n_AI)]
         try:
-            volts = [_bits_to_volts(self._fpga.registers[f"AI{chn}"],
-                                    self._vmax, self._bit_depth) 
-                        for chn in chns]
+            bits = [self._ai_registers[chn].read() for chn in chns]
         except:
             raise
+        volts = list(_bits_to_volts(bits, self._vmax, self._bit_depth))
 
         return volts
 
@@ -249,7 +355,7 @@ class NiFPGA():
         if chns is None:
             chns = list(range(self._n_DIO))
         try:
-            states = [self._fpga.registers[f"DIO{chn}"].read() for chn in chns]
+            states = [self._registers[f"DIO{chn}"].read() for chn in chns]
         except:
             raise
 
@@ -285,8 +391,8 @@ class NiFPGA():
         @return int: error code (0:OK, -1:error)
         """
         try:
-            for fifo in self._fpga.fifos.keys():
-                self._fpga.fifos[fifo].stop()
+            for fifo in self._fifos.values():
+                fifo.stop()
         except:
             print("Couldn't Stop FIFOs")
             raise
@@ -2,6 +2,10 @@ import fpga_base as fb
 from pulse_generator import PulseGen
 from jpe_coord_convert import JPECoord
 import numpy as np
+import numpy.typing as npt
+from collections import deque
+from contextlib import contextmanager
+from threading import Thread, Event, Lock
 from time import sleep, time
 
 pg_config = {"dio_chns" : 16,
@@ -10,7 +14,9 @@ pg_config = {"dio_chns" : 16,
              "gate_dio_chn" : 1,
              "pause_time" : 1E-6,
              "clock_rate" : 120E6,
-             "max_ticks" : np.iinfo(np.uint16).max}
+             "max_ticks" : np.iinfo(np.uint16).max,
+             "cache_size" : 64,
+             "compress" : True}
 pulser = PulseGen(pg_config)
 
 pz_config = {"vmax" : 0,
@@ -24,6 +30,68 @@ pz_conv = JPECoord(pz_config['R'], pz_config['h'],
 class FPGAValueError(Exception):
     pass
 
+class CountRingBuffer():
+    """Fixed size buffer of timestamped count rates, where new samples overwrite the oldest.
+       Samples are numbered in the order they're appended, so a consumer can keep track
+       of the last sample it has seen and only fetch newer ones with `since`.
+       Safe to append from one thread while reading from others.
+
+        Parameters (for __init__)
+        ----------
+        size : int
+            The number of samples kept.
+    """
+    def __init__(self, size : int) -> None:
+        if size < 1:
+            raise FPGAValueError("Buffer size must be at least 1.")
+        self.size = int(size)
+        self._times = np.zeros(self.size)
+        self._rates = np.zeros(self.size)
+        self._total = 0
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return min(self._total, self.size)
+
+    @property
+    def total(self) -> int:
+        """The number of samples appended so far, i.e. the number of the next sample."""
+        return self._total
+
+    def append(self, times : npt.ArrayLike, rates : npt.ArrayLike) -> None:
+        times = np.atleast_1d(times)[-self.size:]
+        rates = np.atleast_1d(rates)
+        n = len(rates)
+        rates = rates[-self.size:]
+        with self._lock:
+            idx = (self._total + n - len(rates) + np.arange(len(rates))) % self.size
+            self._times[idx] = times
+            self._rates[idx] = rates
+            self._total += n
+
+    def since(self, number : int = 0) -> tuple[npt.NDArray, npt.NDArray, int]:
+        """Get every sample from sample `number` onwards that's still in the buffer.
+
+        Returns
+        -------
+        np.ndarray[float]
+            The timestamps of the samples, in s since the epoch.
+        np.ndarray[float]
+            The count rates in counts per second.
+        int
+            The number of the next sample, to pass to the next call.
+        """
+        with self._lock:
+            first = max(number, self._total - self.size, 0)
+            idx = np.arange(first, self._total) % self.size
+            return self._times[idx], self._rates[idx], self._total
+
+    def latest(self, n : int = None) -> tuple[npt.NDArray, npt.NDArray]:
+        """Get the last `n` samples, or every sample in the buffer, oldest first."""
+        n = len(self) if n is None else min(n, len(self))
+        times, rates, _ = self.since(self._total - n)
+        return times, rates
+
 class CryoFPGA(fb.NiFPGA):
     _pulse_pattern_fifo = 'Host to Target DMA'
     _counts_fifo = 'Target to Host DMA'
@@ -39,14 +107,30 @@ class CryoFPGA(fb.NiFPGA):
     _dio_array = [0 for n in range(pg_config['user_dio_chns'])]
     _max_waits = 2
     _max_wait_multiple = 60
-
-    def __init__(self) -> None:
-        super().__init__()
+    # Shortest and longest sleep between polls of a running pattern
+    _min_poll = 20E-6
+    _max_poll = 10E-3
+    # Number of recent waits kept for wait_stats
+    _n_wait_stats = 1000
+
+    def __init__(self, session=None) -> None:
+        super().__init__(session=session)
         self.pulse_pattern = {}
         self.pulse_fifo_data = []
         self._duration = 0
         self.wait_after_ao = 5
         self.count_time = 0
+        # What is currently loaded on the fpga, see write_pulse_pattern
+        self._loaded = None
+        # Number of counts each run of the pattern produces
+        self._n_windows = 0
+        self._waits = deque(maxlen=self._n_wait_stats)
+        self._wait_modes = {'fifo' : 0, 'poll' : 0}
+        # Streaming counts, see start_stream
+        self.stream = None
+        self._stream_thread = None
+        self._stream_stop = Event()
+        self._stream_error = None
 
         self.set_AO_range(self._galvo_x,   [-10.0,10.0])
         self.set_AO_range(self._galvo_y,   [-10.0,10.0])
@@ -58,7 +142,8 @@ class CryoFPGA(fb.NiFPGA):
 
         self.on_activate()
 
-    def set_jpe_pzs(self, x:float = None, y:float = None, z:float = None, write:bool=True) -> None:
+    def set_jpe_pzs(self, x:float = None, y:float = None, z:float = None, write:bool=True,
+                    project:bool=False) -> None:
         volts = [x,y,z]
 
         if any([v is None for v in volts]):
@@ -69,7 +154,10 @@ class CryoFPGA(fb.NiFPGA):
                     
         #Fixed the mistake had a None issue because it was still taking the x,y,z instead of updated valued
         if not pz_conv.check_bounds(volts[0],volts[1],volts[2]): 
-            raise FPGAValueError(f"New JPE Position is outside bounds.")
+            if not project:
+                raise FPGAValueError(f"New JPE Position is outside bounds.")
+            # Move to the closest reachable position instead
+            volts = pz_conv.project(volts)
 
         z_volts = pz_conv.zs_from_cart(volts)
         self.set_AO_volts([self._jpe_uno, self._jpe_due, self._jpe_tre], z_volts)
@@ -112,10 +200,10 @@ class CryoFPGA(fb.NiFPGA):
         if write:
             self.write_values_to_fpga()
     def get_aoms(self) -> list[float]:
-        return self.set_AO_volts([self._red_aom, self._green_aom])
+        return self.get_AO_volts([self._red_aom, self._green_aom])
 
     def get_photodiode(self) -> float:
-        return self.get_AI_volts(self._photodiode_in)
+        return self.get_AI_volts([self._photodiode_in])[0]
 
     def set_dio_array(self, dio_array:list[int], write:bool=True) -> None:
         if len(dio_array) != len(self._dio_array):
@@ -150,28 +238,136 @@ class CryoFPGA(fb.NiFPGA):
         self.count_time = ms * 1E-3
         counts = np.empty(n)
         self.prep_pulse_pattern(pulse_pattern)
+        self.write_pulse_pattern()
 
         for i in range(n):
-            self.write_pulse_pattern()
             counts[i] = self.pulse_and_count()[0]
 
         return counts
 
+    def count_ao_line(self, chns : list[int], volts : npt.ArrayLike, ms : float) -> npt.NDArray[np.float64]:
+        """Count at every point of a line of analog output setpoints, e.g. a row of a galvo scan.
+        The count pattern is uploaded once, then each pixel only writes the AO registers and
+        reruns the pattern, which applies them, waits 'Wait after AO set' and counts.
+        All counts stay in the counts fifo, sized for the whole line, and are read at once,
+        waiting for the last ones to arrive. Any counts left over from before are discarded.
+
+        Parameters
+        ----------
+        chns : list[int]
+            The analog output channels being set.
+        volts : npt.ArrayLike
+            The (N, len(chns)) array of voltages to set on each channel at each pixel.
+        ms : float
+            The count time per pixel in ms.
+
+        Returns
+        -------
+        np.ndarray[float]
+            The N count rates in counts per second.
+        """
+        volts = np.asarray(volts, dtype=float).reshape(-1, len(chns))
+        n_pixels = volts.shape[0]
+        try:
+            self.check_AO_volts(chns, volts)
+        except ValueError as e:
+            raise FPGAValueError(str(e))
+        bits = fb._volts_to_bits(volts, self._vmax, self._bit_depth).tolist()
+
+        dio_array = [0,1] + self.get_dio_array()
+        pulse_pattern = [{'duration' : ms, 'dio_array' : dio_array}]
+        self.pulse_pattern = pulse_pattern
+        self.count_time = ms * 1E-3
+        self.prep_pulse_pattern(pulse_pattern)
+        self.write_pulse_pattern(n_runs=n_pixels)
+        # Only this line's counts should be read back
+        self.read_fifo(self._counts_fifo)
+
+        for pixel in bits:
+            for chn, bit in zip(chns, pixel):
+                self.write_AO_bits(chn, bit)
+            self.write_register('Start FPGA 1', 1)
+            self.wait_for_pattern()
+
+        n_counts = n_pixels * self._n_windows
+        try:
+            with self._unload_on_error():
+                counts = self.read_fifo(self._counts_fifo, n_counts,
+                                        int(np.ceil(self._pattern_timeout() * 1000)))
+        except TimeoutError:
+            raise FPGAValueError(f"Only got some of the {n_counts} counts of the line.")
+        return counts.reshape(n_pixels, -1)[:,0] / self.count_time
+
+    def count_galvo_line(self, xs : npt.ArrayLike, ys : npt.ArrayLike, ms : float) -> npt.NDArray[np.float64]:
+        """Count at every galvo position of a line, see `count_ao_line`.
+
+        Parameters
+        ----------
+        xs : npt.ArrayLike
+            The galvo x voltage at each pixel, or a single value for the whole line.
+        ys : npt.ArrayLike
+            The galvo y voltage at each pixel, or a single value for the whole line.
+        ms : float
+            The count time per pixel in ms.
+
+        Returns
+        -------
+        np.ndarray[float]
+            The count rate at each pixel in counts per second.
+        """
+        xs, ys = np.broadcast_arrays(np.atleast_1d(xs), np.atleast_1d(ys))
+        return self.count_ao_line([self._galvo_x, self._galvo_y], np.stack((xs, ys), axis=-1), ms)
+
     def write_pulse_count(self, pulse_pattern : dict[str, object]) -> None:
         self.prep_pulse_pattern(pulse_pattern)
         self.write_pulse_pattern()
         return self.pulse_and_count()
 
+    def _check_not_streaming(self) -> None:
+        if self._stream_thread is not None:
+            raise FPGAValueError("Can't load a new pattern while streaming counts, call stop_stream first.")
+
     def prep_pulse_pattern(self, pulse_pattern : dict[str, object]) -> None:
+        self._check_not_streaming()
         self._duration = 2/pg_config['clock_rate'] * 1E3
         for step in pulse_pattern:
             self._duration += step['duration'] * 1E-3
 
-        fifo_data = pulser.parse_sequence(pulse_pattern)
+        fifo_data = pulser.compile_sequence(pulse_pattern)
         self.pulse_fifo_data = fifo_data
+        self._n_windows = pulser.count_windows(fifo_data)
 
-    def write_pulse_pattern(self) -> None:
-        fifo_data = self.pulse_fifo_data
+    def prep_pulse_arrays(self, durations : npt.ArrayLike, dio : npt.ArrayLike) -> None:
+        """Same as `prep_pulse_pattern`, for a pattern given as the arrays of its N step
+        durations in ms and (N, n_dio) dio states, see `PulseGen.compile_arrays`. 
+        Much faster for long patterns, since no work is done per step.
+        """
+        self._check_not_streaming()
+        self._duration = 2/pg_config['clock_rate'] * 1E3 + np.sum(durations) * 1E-3
+
+        fifo_data = pulser.compile_arrays(durations, dio)
+        self.pulse_fifo_data = fifo_data
+        self._n_windows = pulser.count_windows(fifo_data)
+
+    def write_pulse_pattern(self, n_runs : int = 1) -> None:
+        """Load the prepared pulse pattern onto the fpga, with room in the counts fifo for
+        `n_runs` runs. If the same pattern and ao wait are already loaded, with enough room
+        for the counts, nothing needs to be sent and the pattern can just be rerun.
+        """
+        self._check_not_streaming()
+        fifo_data = np.asarray(self.pulse_fifo_data, dtype=np.uint32)
+        if fifo_data.flags.writeable:
+            # Keep our own copy, so later changes to the array can't go unnoticed.
+            # Compiled sequences are read-only, so those are kept as is.
+            fifo_data = fifo_data.copy()
+            fifo_data.flags.writeable = False
+        if (self._loaded is not None
+            and (self._loaded['data'] is fifo_data 
+                 or np.array_equal(self._loaded['data'], fifo_data))
+            and self._loaded['wait'] == self.wait_after_ao
+            and self._loaded['counts_size'] >= self._loaded['ht_size'] * n_runs):
+            return
+        self._loaded = None
 
         self.write_register('Start FPGA 1', 0)
 
@@ -179,8 +375,9 @@ class CryoFPGA(fb.NiFPGA):
         ht_size = self.set_size_fifo(self._pulse_pattern_fifo, len(fifo_data))
         # Let FPGA know the real size
         self.write_register('H toT Size', ht_size)
-        # Set target->host size with true size
-        self.set_size_fifo(self._counts_fifo, ht_size)
+        # Set target->host size with true size, with room for the
+        # counts of every run if the pattern will be run multiple times
+        counts_size = self.set_size_fifo(self._counts_fifo, ht_size * n_runs)
         self.write_register('Wait after AO set (us)', self.wait_after_ao * 1000)
         # Set count mode to false => no averaging
         self.write_register('Counting Mode', 0)
@@ -191,39 +388,215 @@ class CryoFPGA(fb.NiFPGA):
         
         # Send the pulse pattern data to the fpga, with 5s timeout
         self.write_fifo(self._pulse_pattern_fifo, fifo_data, 5000)
+        self._loaded = {'data' : fifo_data,
+                        'wait' : self.wait_after_ao,
+                        'ht_size' : ht_size,
+                        'counts_size' : counts_size}
         
     def pulse_and_count(self) -> list[float]:
         self.write_register('Start FPGA 1', 1)
+        with self._unload_on_error():
+            counts = self._wait_for_counts()
+        return counts / self.count_time
+
+    def wait_for_pattern(self) -> None:
+        with self._unload_on_error():
+            start = time()
+            polls = self._wait_for_pattern(start, start + self._pattern_timeout())
+            self._record_wait('poll', time() - start, polls)
+
+    @contextmanager
+    def _unload_on_error(self):
+        """Forget what's loaded on the fpga if waiting on a pattern fails, since there
+        could be leftover counts or a stuck pattern, so everything is reloaded next time.
+        """
+        try:
+            yield
+        except:
+            self._loaded = None
+            raise
+
+    def _pattern_timeout(self) -> float:
         if self._duration > 1E-3:
             duration = self._duration
         else:
             # Computers are too imprecise in timing
             # so always wait at least 1ms
             duration = 1E-3
-        # For 'slow' pulses, we can wait a reasonable time.
         if duration > 15E-3:
-            sleep(duration)
-            for i in range(self._max_waits):
-                if not self.read_register('Start FPGA 1'):
-                    break
-                else:
-                    sleep(duration)
-            else:
-                raise TimeoutError("Pulse pattern timed out.")
-        # For 'fast' pulse, python can't wait a small enough amount of time (>15ms)
-        # so instead we constantly poll until the fpga is done, with a timeout.
-        # sleep(0) is much faster, a little under a millisecond, so adds a nice small delay
-        else:
-            start = time()
-            while (time() - start) < (duration * self._max_wait_multiple):
-                if not self.read_register('Start FPGA 1'):
-                    break
-                else:
-                    sleep(0)
-            else:
+            return duration * (self._max_waits + 1)
+        return duration * self._max_wait_multiple
+
+    def _wait_for_counts(self, out : npt.NDArray[np.uint32] = None) -> npt.NDArray[np.uint32]:
+        """Wait for the running pattern to finish and return its raw counts.
+        The fifo read blocks until every gate window has been counted, without holding
+        the GIL or polling. If the counts don't all arrive, which also covers patterns
+        without gate windows, falls back to polling the pattern until it's done.
+        Any extra counts left in the fifo are read as well, using the number of elements
+        left reported by the blocking read, so the fifo is only probed when polling.
+        The counts are read into `out` if given, which must hold one count per gate window.
+        """
+        start = time()
+        deadline = start + self._pattern_timeout()
+        counts = np.empty(0, dtype=np.uint32)
+        remaining = None
+        mode = 'poll'
+        if self._n_windows > 0:
+            if out is None:
+                out = np.empty(self._n_windows, dtype=np.uint32)
+            try:
+                remaining = self.read_fifo_into(self._counts_fifo, out[:self._n_windows],
+                                                int(np.ceil((deadline - start) * 1000)))
+                counts = out[:self._n_windows]
+                mode = 'fifo'
+            except TimeoutError:
+                pass
+        # Only the end of the pattern can be left once the counts are in.
+        polls = self._wait_for_pattern(start, deadline)
+        extra = self.read_fifo(self._counts_fifo, remaining)
+        if len(extra):
+            counts = np.concatenate((counts, extra))
+        self._record_wait(mode, time() - start, polls)
+        return counts
+
+    def _wait_for_pattern(self, start : float, deadline : float) -> int:
+        """Poll the fpga until the pattern started at `start` is done, sleeping for
+        exponentially longer between polls, from `_min_poll` up to `_max_poll`.
+        The first sleep skips most of the pattern, since it can't be done before then.
+
+        Returns
+        -------
+        int
+            The number of times the fpga was polled.
+        """
+        delay = self._min_poll
+        remaining = start + self._duration - self._max_poll - time()
+        if remaining > 0:
+            sleep(remaining)
+        polls = 0
+        while True:
+            polls += 1
+            if not self.read_register('Start FPGA 1'):
+                return polls
+            if time() > deadline:
                 raise TimeoutError("Pulse pattern timed out.")
+            sleep(delay)
+            delay = min(2 * delay, self._max_poll)
+
+    def _record_wait(self, mode : str, elapsed : float, polls : int) -> None:
+        self._wait_modes[mode] += 1
+        self._waits.append((elapsed, max(elapsed - self._duration, 0), polls))
+
+    def wait_stats(self) -> dict[str, float]:
+        """Statistics of the most recent waits for patterns to finish.
+        'wait' is the time spent waiting in s, 'overhead' is how much longer
+        than the pattern that was, and 'polls' the number of times the fpga was polled.
+        'fifo' and 'poll' count how many waits completed on the counts fifo or by polling.
+        """
+        stats = {'n' : len(self._waits), **self._wait_modes}
+        if not self._waits:
+            return stats
+        waits = np.array(self._waits)
+        for i, name in enumerate(['wait', 'overhead']):
+            stats[f"{name}_mean"] = float(np.mean(waits[:,i]))
+            stats[f"{name}_median"] = float(np.median(waits[:,i]))
+            stats[f"{name}_p95"] = float(np.percentile(waits[:,i], 95))
+            stats[f"{name}_max"] = float(np.max(waits[:,i]))
+        stats['polls_mean'] = float(np.mean(waits[:,2]))
+        return stats
+
+    def reset_wait_stats(self) -> None:
+        self._waits.clear()
+        self._wait_modes = {'fifo' : 0, 'poll' : 0}
+
+    def start_stream(self, ms : float, block : int = 100, buffer_size : int = 100000) -> CountRingBuffer:
+        """Start counting continuously in the background. A pattern of `block` count windows
+        is loaded once, and a reader thread keeps rerunning it, waiting on the counts fifo and
+        putting the timestamped count rates into a ring buffer, so consumers just read the
+        buffer instead of running a count each. The windows are separated by a single
+        clock tick, and there's a short gap every `block` windows while the pattern is rerun.
+        Analog outputs can be changed with `write=False` while streaming, they're applied
+        at the start of the next block.
+
+        Parameters
+        ----------
+        ms : float
+            The count time of each window in ms.
+        block : int, optional
+            How many windows are counted per run of the pattern, by default 100.
+        buffer_size : int, optional
+            How many count rates are kept, by default 100000.
+
+        Returns
+        -------
+        CountRingBuffer
+            The buffer being filled, also available as `stream`.
+        """
+        if self._stream_thread is not None:
+            raise FPGAValueError("Already streaming counts.")
+        if block < 1:
+            raise FPGAValueError("Must count at least one window per block.")
+        gate_on = [0,1] + self.get_dio_array()
+        gate_off = [0,0] + self.get_dio_array()
+        gap = 1/pg_config['clock_rate'] * 1E3
+        self.pulse_pattern = [{'duration' : ms, 'dio_array' : gate_on},
+                              {'duration' : gap, 'dio_array' : gate_off}] * block
+        self.count_time = ms * 1E-3
+        self.prep_pulse_arrays(np.tile([ms, gap], block), 
+                               np.tile(np.array([gate_on, gate_off], dtype=bool), (block, 1)))
+        self.write_pulse_pattern()
 
-        return self.get_counts()
+        self.stream = CountRingBuffer(buffer_size)
+        self._stream_stop.clear()
+        self._stream_error = None
+        self._stream_thread = Thread(target=self._stream_counts, args=((ms + gap) * 1E-3, ms * 1E-3),
+                                     daemon=True)
+        self._stream_thread.start()
+        return self.stream
+
+    def _stream_counts(self, period : float, count_time : float) -> None:
+        block = np.empty(self._n_windows, dtype=np.uint32)
+        try:
+            with self._unload_on_error():
+                while not self._stream_stop.is_set():
+                    self.write_register('Start FPGA 1', 1)
+                    counts = self._wait_for_counts(block)
+                    end = time()
+                    self.stream.append(end + period * np.arange(1 - len(counts), 1),
+                                       counts / count_time)
+        except Exception as e:
+            self._stream_error = e
+
+    def stop_stream(self) -> None:
+        """Stop streaming counts, re-raising any error that stopped the reader thread.
+        The buffer stays available as `stream`.
+        """
+        self._halt_stream()
+        if self._stream_error is not None:
+            error = self._stream_error
+            self._stream_error = None
+            raise error
+
+    def _halt_stream(self) -> None:
+        if self._stream_thread is None:
+            return
+        self._stream_stop.set()
+        self._stream_thread.join()
+        self._stream_thread = None
+
+    @property
+    def streaming(self) -> bool:
+        return self._stream_thread is not None and self._stream_thread.is_alive()
+
+    def reset_hardware(self):
+        self._halt_stream()
+        self._loaded = None
+        return super().reset_hardware()
+
+    def close_fpga(self):
+        self._halt_stream()
+        self._loaded = None
+        return super().close_fpga()
 
     def get_counts(self, per_second:bool = True) -> list[float]:
         if per_second:
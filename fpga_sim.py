@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated stand-in for `nifpga.session.Session`, running the pulse pattern bitfile
+used by `CryoFPGA` in software, so counting can be run and benchmarked off the rig:
+
+    fpga = CryoFPGA(session=SimSession())
+"""
+
+import numpy as np
+from collections import namedtuple
+from threading import Lock
+from time import perf_counter, sleep
+from typing import Callable, Union
+import fpga_base as fb
+from pulse_generator import PulseGen, config as pg_config
+
+ReadValues = namedtuple("ReadValues", ["data", "elements_remaining"])
+
+class SimRegister():
+    def __init__(self, session : "SimSession", name : str, value : int = 0) -> None:
+        self._session = session
+        self.name = name
+        self.value = value
+
+    def read(self):
+        return self._session._read_register(self)
+
+    def write(self, value) -> None:
+        self._session._write_register(self, value)
+
+class SimFifo():
+    """A DMA fifo, holding elements along with the time they reach the other side."""
+    def __init__(self, session : "SimSession", name : str) -> None:
+        self._session = session
+        self.name = name
+        self.depth = 0
+        self.running = False
+        self._data = np.empty(0, dtype=np.uint32)
+        self._ready = np.empty(0)
+
+    def configure(self, requested_depth : int) -> int:
+        self.depth = int(requested_depth)
+        return self.depth
+
+    def start(self) -> None:
+        self.running = True
+
+    def stop(self) -> None:
+        with self._session._lock:
+            self.running = False
+            self._data = np.empty(0, dtype=np.uint32)
+            self._ready = np.empty(0)
+
+    def write(self, data, timeout_ms : int = 0) -> None:
+        data = np.asarray(data, dtype=np.uint32)
+        if self.depth and len(self._data) + len(data) > self.depth:
+            raise TimeoutError(f"Not enough room in {self.name} for {len(data)} elements.")
+        self._push(data, np.full(len(data), perf_counter()))
+
+    def read(self, number_of_elements : int, timeout_ms : int = 0) -> ReadValues:
+        """Read elements that have arrived, waiting up to `timeout_ms` for them,
+        and raising TimeoutError like the driver if they don't arrive in time.
+        """
+        end = perf_counter() + timeout_ms / 1000
+        with self._session._lock:
+            # Time at which the requested number of elements will all have arrived
+            if number_of_elements == 0:
+                arrival = 0
+            elif number_of_elements <= len(self._ready):
+                arrival = self._ready[number_of_elements - 1]
+            else:
+                arrival = np.inf
+        wait = min(arrival, end) - perf_counter()
+        if wait > 0:
+            sleep(wait)
+        if arrival > end:
+            raise TimeoutError(f"Timed out reading {number_of_elements} elements from {self.name}.")
+        with self._session._lock:
+            data = self._data[:number_of_elements]
+            self._data = self._data[number_of_elements:]
+            self._ready = self._ready[number_of_elements:]
+            remaining = np.count_nonzero(self._ready <= perf_counter())
+        return ReadValues(data, remaining)
+
+    def _push(self, data : np.ndarray, ready : np.ndarray) -> None:
+        with self._session._lock:
+            self.running = True
+            self._data = np.concatenate((self._data, data.astype(np.uint32)))
+            self._ready = np.concatenate((self._ready, ready))
+
+class SimSession():
+    """Simulated session of the pulse pattern bitfile. Setting 'Start FPGA 1' runs the
+       pulse pattern written to the 'Host to Target DMA' fifo: after waiting
+       'Wait after AO set (us)', the pattern's words are decoded, and for every gate
+       window a Poisson distributed number of counts is pushed to the
+       'Target to Host DMA' fifo, arriving `dma_latency` after the window ends.
+       'Start FPGA 1' reads back as 1 until the pattern is done.
+       The same registers and fifos as the real bitfile are available, analog outputs
+       just hold the last value written and analog inputs read 0.
+
+        Parameters (for __init__)
+        ----------
+        count_rate : Union[float, Callable], optional
+            The count rate in counts per second, or a function taking the list of analog
+            output voltages when the pattern is started and returning the count rate,
+            e.g. to simulate a confocal image. By default 1E5
+        dma_latency : float, optional
+            How long counts take to reach the host after their window ends in s,
+            by default 50E-6
+        seed : int, optional
+            Seed of the random counts, by default None
+        pulser : PulseGen, optional
+            Used to decode the pulse pattern, by default one using the default config.
+    """
+    _n_AI = 8
+    _n_AO = 8
+    _n_DIO = 8
+    _registers = ['Start FPGA 1', 'H toT Size', 'Wait after AO set (us)', 'Counting Mode']
+    _fifos = ['Host to Target DMA', 'Target to Host DMA']
+
+    def __init__(self, count_rate : Union[float, Callable[[list[float]], float]] = 1E5,
+                 dma_latency : float = 50E-6,
+                 seed : int = None,
+                 pulser : PulseGen = None) -> None:
+        self.count_rate = count_rate
+        self.dma_latency = dma_latency
+        self.pulser = PulseGen(pg_config) if pulser is None else pulser
+        self._rng = np.random.default_rng(seed)
+        self._lock = Lock()
+        self._done = 0
+        self._closed = False
+
+        names = (self._registers
+                 + [f"AO{chn}" for chn in range(self._n_AO)]
+                 + [f"AI{chn}" for chn in range(self._n_AI)]
+                 + [f"DIO{chn}" for chn in range(self._n_DIO)])
+        self.registers = {name : SimRegister(self, name) for name in names}
+        self.fifos = {name : SimFifo(self, name) for name in self._fifos}
+
+    def reset(self) -> None:
+        for register in self.registers.values():
+            register.value = 0
+        for fifo in self.fifos.values():
+            fifo.stop()
+        self._done = 0
+
+    def close(self) -> None:
+        self._closed = True
+
+    def _check_open(self) -> None:
+        if self._closed:
+            raise RuntimeError("Session is closed.")
+
+    def _read_register(self, register : SimRegister):
+        self._check_open()
+        if register.name == 'Start FPGA 1':
+            return int(perf_counter() < self._done)
+        return register.value
+
+    def _write_register(self, register : SimRegister, value) -> None:
+        self._check_open()
+        if register.name == 'Start FPGA 1':
+            if value and perf_counter() >= self._done:
+                self._run_pattern()
+            return
+        register.value = value
+
+    def _rate(self) -> float:
+        if callable(self.count_rate):
+            bits = [self.registers[f"AO{chn}"].value for chn in range(self._n_AO)]
+            return self.count_rate(list(fb._bits_to_volts(bits, fb.NiFPGA._vmax, fb.NiFPGA._bit_depth)))
+        return self.count_rate
+
+    def _run_pattern(self) -> None:
+        """Run the pulse pattern from now, scheduling its counts and when it finishes."""
+        start = perf_counter() + self.registers['Wait after AO set (us)'].value * 1E-6
+        ticks, dio = self.pulser.decode(self.fifos['Host to Target DMA']._data)
+        ends = np.cumsum(ticks) / self.pulser.cr
+        gate = dio[:,self.pulser.gate].astype(bool)
+        # Edges of every run of words with the gate on
+        edges = np.diff(np.concatenate(([False], gate, [False])).astype(np.int8))
+        first = np.flatnonzero(edges == 1)
+        last = np.flatnonzero(edges == -1) - 1
+        window_ends = ends[last]
+        window_times = window_ends - (ends[first] - ticks[first] / self.pulser.cr)
+        counts = self._rng.poisson(self._rate() * window_times)
+        self._done = start + (ends[-1] if len(ends) else 0)
+        self.fifos['Target to Host DMA']._push(counts, start + window_ends + self.dma_latency)
+
+if __name__ == "__main__":
+    # Benchmark the counting hot paths against the simulator.
+    from fpga_cryo import CryoFPGA
+    fpga = CryoFPGA(session=SimSession(seed=0))
+    fpga.set_ao_wait(0, write=False)
+    for ms in [0.01, 1, 10]:
+        fpga.reset_wait_stats()
+        n = int(min(1000, 1000 / ms))
+        start = perf_counter()
+        counts = fpga.count_n_times(ms, n)
+        elapsed = perf_counter() - start
+        stats = fpga.wait_stats()
+        print(f"{ms}ms windows: {n / elapsed:.0f} counts/s, {elapsed / n * 1E3:.3f}ms per count, "
+              f"median overhead {stats['overhead_median'] * 1E3:.3f}ms, "
+              f"mean rate {np.mean(counts):.0f}cps")
@@ -1,4 +1,7 @@
 import numpy as np
+import numpy.typing as npt
+from functools import lru_cache
+from itertools import product
 
 def _from_zs_matrix(radius, height):
     h = height
@@ -23,50 +26,96 @@ def _to_zs_matrix(radius, height):
 class JPECoord():
 
     def __init__(self, radius : float, height : float, 
-                       zmin : float, zmax : float) -> None:
+                       zmin : float, zmax : float,
+                       bounds_resolution : float = 1E-6,
+                       cache_size : int = 256) -> None:
         self.R = radius
         self.h = height
         self.zmin = zmin
         self.zmax = zmax
         self.mat_from_zs = _from_zs_matrix(radius, height)
         self.mat_to_zs = _to_zs_matrix(radius, height)
+        self._mat_to_cart = np.linalg.inv(self.mat_to_zs)
+        self._active_sets = _active_sets(self._mat_to_cart, zmin, zmax)
 
-    def cart_from_zs(self, zs: list[float]) -> list[float]:
-        return self.from_zs(zs)[:3]
+        # Cache of bounds polygons, keyed by axis and constant value rounded
+        # to bounds_resolution.
+        self.bounds_resolution = bounds_resolution
+        self.cache_size = cache_size
+        self._bounds = lru_cache(maxsize=cache_size)(self._compute_bounds)
+
+    # Conversions take either a single position, or an (N,3) array
+    # of positions, converting all of them at once.
+    def cart_from_zs(self, zs: npt.ArrayLike) -> npt.NDArray:
+        return self.from_zs(zs)[...,:3]
     
-    def rot_from_zs(self, zs: list[float]) -> list[float]:
-        return self.from_zs(zs)[3:]
+    def rot_from_zs(self, zs: npt.ArrayLike) -> npt.NDArray:
+        return self.from_zs(zs)[...,3:]
     
-    def from_zs(self, zs: list[float]) -> list[float]:
-        return self.mat_from_zs @ zs
+    def from_zs(self, zs: npt.ArrayLike) -> npt.NDArray:
+        return np.asarray(zs, dtype=float) @ self.mat_from_zs.T
     
-    def zs_from_cart(self, cart: list[float]) -> list[float]:
-        return self.mat_to_zs @ cart
+    def zs_from_cart(self, cart: npt.ArrayLike) -> npt.NDArray:
+        return np.asarray(cart, dtype=float) @ self.mat_to_zs.T
 
     def bounds(self, const_axis : str ='z', 
-                     const_value : float = 0) -> list[float]:
-        func_dic = {'x' : _xlims, 'y' : _ylims, 'z' : _zlims}
-        if const_axis not in func_dic.keys():
+                     const_value : float = 0) -> npt.NDArray:
+        """The vertices of the region that can be reached in the plane where `const_axis`
+        is `const_value`, sorted by angle around their center. The constant value is
+        rounded to `bounds_resolution`, and the last `cache_size` polygons are kept,
+        so repeated calls are just a lookup. The returned array is read-only.
+        """
+        if const_axis not in ('x', 'y', 'z'):
             raise ValueError(f"Invalid constant axis: {const_axis}")
+        if self.bounds_resolution:
+            quantum = int(round(const_value / self.bounds_resolution))
+        else:
+            quantum = const_value
+        return self._bounds(const_axis, quantum)
+
+    def bounds_cache_info(self):
+        """Hits, misses and size of the `bounds` cache, see `functools.lru_cache`."""
+        return self._bounds.cache_info()
+
+    def _compute_bounds(self, const_axis : str, quantum : float) -> npt.NDArray:
+        func_dic = {'x' : _xlims, 'y' : _ylims, 'z' : _zlims}
+        if self.bounds_resolution:
+            const_value = quantum * self.bounds_resolution
+        else:
+            const_value = quantum
         # Generate the bounding vertices
         pts = func_dic[const_axis](const_value, self.zmin, self.zmax, self.R, self.h)
         pts = np.array(pts)
         # Ordering the points by angle relative to their central position.
         mid = np.mean(pts,axis=0)
-        sortfunc = lambda x: np.arctan2(x[1]-mid[1],x[0]-mid[0])
-        order = np.apply_along_axis(sortfunc, 1, pts).argsort()
-        return pts[order]
+        order = np.arctan2(pts[:,1]-mid[1], pts[:,0]-mid[0]).argsort()
+        pts = pts[order]
+        pts.flags.writeable = False
+        return pts
     
-    def inbounds(self,point : list[float], poly_points : list[list[float]]) -> bool:
-        subbed_points = poly_points - point
-        angle_signs = []
-        n = poly_points.shape[0]
-        for i, point in enumerate(subbed_points):
-            ip1 = (i+1) % n
-            sign = subbed_points[ip1][0]*point[1] > point[0]*subbed_points[ip1][1]
-            angle_signs.append(sign)
-        angle_signs = np.array([angle_signs])
-        return not np.any(np.diff(angle_signs))
+    def inbounds(self, point : npt.ArrayLike, poly_points : npt.ArrayLike):
+        """Check whether points are inside a convex polygon, i.e. on the same side of
+        every edge. `point` can be a single point, returning a bool, or an (N,2) array
+        of points, returning a boolean mask.
+        """
+        point = np.asarray(point, dtype=float)
+        poly_points = np.asarray(poly_points, dtype=float)
+        subbed_points = poly_points - point[...,None,:]
+        next_points = np.roll(subbed_points, -1, axis=-2)
+        signs = (next_points[...,0]*subbed_points[...,1] 
+                 > subbed_points[...,0]*next_points[...,1])
+        inside = np.all(signs, axis=-1) | ~np.any(signs, axis=-1)
+        if inside.ndim == 0:
+            return bool(inside)
+        return inside
+
+    def inbounds_slice(self, points : npt.ArrayLike, const_axis : str = 'z',
+                       const_value : float = 0):
+        """Check whether points in the plane where `const_axis` is `const_value` can be
+        reached, using the cached `bounds`. The points are given in the same order as
+        the vertices of `bounds`, e.g. (x,y) for a constant z.
+        """
+        return self.inbounds(points, self.bounds(const_axis, const_value))
 
     """
     def check_bounds(self, x:float,y:float,z:float, set_pos:list[float]):
@@ -81,12 +130,101 @@ class JPECoord():
             bounds = self.bounds('z', set_pos[2])
             return self.inbounds([x,y],bounds)
     """
-    def check_bounds(self, x:float, y:float, z:float):
-        zs = self.zs_from_cart([x,y,z])
-        for z in zs:
-            if not (self.zmax >= z >= self.zmin):
-                return False
-        return True
+    def check_bounds(self, x:npt.ArrayLike, y:npt.ArrayLike, z:npt.ArrayLike):
+        """Check whether positions can be reached without any actuator going out of range.
+        The coordinates can be single values or broadcastable arrays, e.g. from
+        `np.meshgrid`, in which case a boolean mask of the broadcast shape is returned.
+        """
+        zs = self.zs_from_cart(np.stack(np.broadcast_arrays(x, y, z), axis=-1))
+        mask = np.all((zs >= self.zmin) & (zs <= self.zmax), axis=-1)
+        if mask.ndim == 0:
+            return bool(mask)
+        return mask
+
+    def check_bounds_cart(self, cart : npt.ArrayLike) -> npt.NDArray[np.bool_]:
+        """Same as `check_bounds`, for an (N,3) array of positions."""
+        zs = self.zs_from_cart(cart)
+        return np.all((zs >= self.zmin) & (zs <= self.zmax), axis=-1)
+
+    def project(self, cart : npt.ArrayLike) -> npt.NDArray:
+        """Find the closest reachable position to each given position.
+        Reachable positions are those where every actuator is within [zmin, zmax],
+        so this is a least squares problem over the actuators with box constraints.
+        It's solved exactly by trying every combination of actuators being at either
+        limit or free, solving for the free ones, and keeping the closest solution
+        that respects the limits. Positions that are already reachable are unchanged.
+
+        Parameters
+        ----------
+        cart : npt.ArrayLike
+            A single (x,y,z) position, or an (N,3) array of positions.
+
+        Returns
+        -------
+        np.ndarray[float]
+            The closest reachable positions, shaped like `cart`.
+        """
+        cart = np.asarray(cart, dtype=float)
+        pts = cart.reshape(-1,3)
+        tol = 1E-9 * (self.zmax - self.zmin)
+        best = np.full(len(pts), np.inf)
+        best_zs = np.empty((len(pts),3))
+        for free, fixed, values, pinv in self._active_sets:
+            zs = np.empty((len(pts),3))
+            zs[:,fixed] = values
+            zs[:,free] = (pts - values @ self._mat_to_cart[:,fixed].T) @ pinv.T
+            dist = np.sum((zs @ self._mat_to_cart.T - pts)**2, axis=1)
+            free_zs = zs[:,free]
+            dist[np.any((free_zs < self.zmin - tol) | (free_zs > self.zmax + tol), axis=1)] = np.inf
+            closer = dist < best
+            best[closer] = dist[closer]
+            best_zs[closer] = zs[closer]
+        # The solution with every actuator at a limit is always feasible, so one is always found.
+        # Stay just inside the limits, so rounding errors can't push the result out of bounds.
+        best_zs = np.clip(best_zs, self.zmin + tol, self.zmax - tol)
+        return (best_zs @ self._mat_to_cart.T).reshape(cart.shape)
+
+    def plan_scan(self, xs : npt.ArrayLike, ys : npt.ArrayLike, zs : npt.ArrayLike) -> dict[str, object]:
+        """Check how much of a scan grid can be reached, to shrink or recenter it before
+        running it.
+
+        Parameters
+        ----------
+        xs, ys, zs : npt.ArrayLike
+            The positions along each axis of the scan, or a single value for a fixed axis.
+
+        Returns
+        -------
+        dict[str, object]
+            'mask' : np.ndarray[bool], which points of the (len(xs), len(ys), len(zs)) grid can be reached.
+            'fraction' : float, the fraction of the grid that can be reached.
+            'bounds' : np.ndarray[float], the [min, max] of each axis over the reachable points,
+            or None if none are.
+            'center' : np.ndarray[float], the center of those bounds, or None.
+        """
+        grid = np.meshgrid(np.atleast_1d(xs), np.atleast_1d(ys), np.atleast_1d(zs), indexing='ij')
+        mask = self.check_bounds(*grid)
+        if not np.any(mask):
+            return {"mask" : mask, "fraction" : 0.0, "bounds" : None, "center" : None}
+        reachable = np.stack([axis[mask] for axis in grid], axis=-1)
+        bounds = np.stack((reachable.min(axis=0), reachable.max(axis=0)), axis=-1)
+        return {"mask" : mask,
+                "fraction" : float(np.mean(mask)),
+                "bounds" : bounds,
+                "center" : np.mean(bounds, axis=-1)}
+
+def _active_sets(mat_to_cart, zmin : float, zmax : float) -> list[tuple]:
+    """Every way of fixing each actuator at zmin, zmax, or leaving it free,
+    along with what's needed to find the closest point with the free ones.
+    """
+    sets = []
+    for limits in product((None, zmin, zmax), repeat=3):
+        free = np.array([i for i, lim in enumerate(limits) if lim is None], dtype=int)
+        fixed = np.array([i for i, lim in enumerate(limits) if lim is not None], dtype=int)
+        values = np.array([lim for lim in limits if lim is not None], dtype=float)
+        pinv = np.linalg.pinv(mat_to_cart[:,free]) if len(free) else np.zeros((0,3))
+        sets.append((free, fixed, values, pinv))
+    return sets
 
 def _zlims(z,zmin : float, zmax : float, R : float, h : float) -> list[list[float]]:
     zmid = (zmin + zmax)/2
@@ -6,7 +6,8 @@ import numpy.typing as npt
 from jpe_coord_convert import JPECoord
 from time import time
 from pathlib import Path
-from subprocess import Popen, run, DEVNULL, CREATE_NEW_CONSOLE
+from subprocess import Popen, DEVNULL, CREATE_NEW_CONSOLE
+from cacli_session import CacliSession
 from warnings import warn
 from threading import Thread
 from typing import Union, Callable, Tuple
@@ -50,7 +51,9 @@ stp_config = {"z_min" : -5750.0,            # um
               "type" : "CA1801",            # Basically never change this
               "serial" : "1038E201702-004", # Basically never change this
               "exe_path" : r"X:\DiamondCloud\Fiber_proj_ctrl_softwares\Cryo Control\JPE vis\CPS_control\cacli.exe",
-              "pos_path" : r"X:\DiamondCloud\Fiber_proj_ctrl_softwares\Cryo Control\JPE vis\PositionZeroRegister.asc"} 
+              "pos_path" : r"X:\DiamondCloud\Fiber_proj_ctrl_softwares\Cryo Control\JPE vis\PositionZeroRegister.asc",
+              "cacli_timeout" : 10.0,       # s
+              "init_timeout" : 60.0}        # s, initializing can take much longer
 
 stp_conv = JPECoord(stp_config['R'], stp_config['h'],
                     stp_config['z_min'], stp_config['z_max'])
@@ -130,6 +133,13 @@ class JPEStepper():
             self.emulator = False
             self.pipe = None
         self.serial = config['serial']
+        # All commands go through one session, rather than each setting up their own call.
+        if self.emulator:
+            argv = [self.exe]
+        else:
+            argv = [self.exe, f"@SERV:{self.serial}"]
+        self.session = CacliSession(argv, config['cacli_timeout'])
+        self.init_timeout = config['init_timeout']
 
         # The vectors that store the relevant zeroing and position offsets
         # As well as wether to subtract the offset for a given axis.
@@ -456,15 +466,15 @@ class JPEStepper():
         command = commands.get(command,command)
         string_args = [str(arg) for arg in args]
 
-        if self.emulator:
-            res = run([self.exe,command] + string_args,capture_output=True)
-        else:
-            res = run([self.exe, f"@SERV:{self.serial}", command] + string_args, 
-                      capture_output=True)
+        if not self.emulator and self.pipe is not None and self.pipe.poll() is not None:
+            log.warn("cacli server exited, restarting it.")
+            self.open_pipe()
+        timeout = self.init_timeout if command == 'FBEN' else None
+        out = self.session.request([command] + string_args, timeout)
 
         if command != "FBST":
             log.debug(f"Sending cacli message {' '.join([command] + string_args)}")
-        msg = res.stdout.strip()
+        msg = out.strip()
         msg = msg.strip().decode('UTF-8')
         if "UNAUTHORIZED COMMAND" in msg:
             log.warn(f"'{command}' is invalid in the current context. cacli returned '{msg}'")
@@ -496,6 +506,9 @@ class JPEStepper():
             except IndexError as e:
                 print("Error occured while getting status, trying again:")
                 print(e)
+            except TimeoutError as e:
+                print("Error occured while getting status, trying again:")
+                print(e)
 
         raise RuntimeError("Could not get stage status.")
     
@@ -6,6 +6,7 @@ import numpy.typing as npt
 from jpe_coord_convert import JPECoord
 from pathlib import Path
 from subprocess import run
+from cacli_session import CacliSession
 from warnings import warn
 from threading import Thread
 from multiprocessing import Process
@@ -46,7 +47,9 @@ stp_config = {"z_min" : -5750.0,          # um
               "xy_lim" : [-1000.0,1000.0],  # um
               "type" : "CA1801",        # Basically never change this
               "exe_path" : r"C:\Users\Childresslab\Documents\cacli_emulator\cacli_emulator.exe",
-              "pos_path" : r"X:\DiamondCloud\Cryostat setup\Control\cryocontrol\emu_cryo_pos.csv"}
+              "pos_path" : r"X:\DiamondCloud\Cryostat setup\Control\cryocontrol\emu_cryo_pos.csv",
+              "cacli_timeout" : 10.0,   # s
+              "init_timeout" : 60.0}    # s, initializing can take much longer
 
 stp_conv = JPECoord(stp_config['R'], stp_config['h'],
                     stp_config['z_min'], stp_config['z_max'])
@@ -64,7 +67,9 @@ class JPEStepper():
             be used to update the default stp_config configuration, allowing
             for only a few configuration variables to be passed in.
         """
-        config = stp_config.update(config)
+        new_config = stp_config.copy()
+        new_config.update(config)
+        config = new_config
         # These set the absolute maximum positions of the stage
         # Unfortunately we can't easily zero the stage, so these
         # aren't super useful since we have no idea where the stage
@@ -113,6 +118,13 @@ class JPEStepper():
         else:
             self.emulator = False
             self.pipe = None
+        # All commands go through one session, rather than each setting up their own call.
+        if self.emulator:
+            argv = [self.exe]
+        else:
+            argv = [self.exe, f"@SERV:{config.get('serial')}"]
+        self.session = CacliSession(argv, config['cacli_timeout'])
+        self.init_timeout = config['init_timeout']
 
         # The vectors that store the relevant zeroing and position offsets
         # As well as wether to subtract the offset for a given axis.
@@ -421,15 +433,12 @@ class JPEStepper():
         command = commands.get(command,command)
         string_args = [str(arg) for arg in args]
 
-        if self.emulator:
-            res = run([self.exe,command] + string_args,capture_output=True)
-        else:
-            res = run([self.exe, f"@SERV:{self.serial}", command] + string_args, 
-                      capture_output=True)
+        timeout = self.init_timeout if command == 'FBEN' else None
+        out = self.session.request([command] + string_args, timeout)
 
         if command != "FBST":
             log.debug(f"Sending cacli message {' '.join([command] + string_args)}")
-        msg = res.stdout.strip()
+        msg = out.strip()
         msg = msg.strip().decode('UTF-8')
         if "UNAUTHORIZED COMMAND" in msg:
             log.warn(f"'{command}' is invalid in the current context. cacli returned '{msg}'")
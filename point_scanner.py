@@ -0,0 +1,302 @@
+from typing import Callable
+import numpy as np
+import numpy.typing as npt
+from inspect import signature
+from warnings import warn
+from pathlib import Path
+from scanner import _check_n_params, _safe_file_name, _sweep, _run_async
+
+def travel_costs(start : npt.ArrayLike, ends : npt.ArrayLike, weights : npt.ArrayLike) -> npt.NDArray:
+    """The cost of moving from `start` to each point of `ends`. Every axis is moved
+       one after the other, so the cost is the sum along each axis of the distance
+       travelled times that axis' weight.
+
+    Parameters
+    ----------
+    start : npt.ArrayLike
+        The position, or (N, n_axes) array of positions, being moved from.
+    ends : npt.ArrayLike
+        The (N, n_axes) array of positions being moved to.
+    weights : npt.ArrayLike
+        The cost per unit of travel along each axis, e.g. seconds per micron.
+
+    Returns
+    -------
+    np.ndarray[float]
+        The N costs of each move.
+    """
+    return np.sum(np.abs(np.asarray(ends) - np.asarray(start)) * weights, axis=-1)
+
+def order_points(points : npt.ArrayLike, weights : npt.ArrayLike = None,
+                 start : npt.ArrayLike = None, max_passes : int = 20) -> npt.NDArray[np.int_]:
+    """Find a short path visiting every point once, using a nearest-neighbour tour
+       improved by 2-opt, i.e. reversing parts of the path as long as it shortens it.
+       This won't necessarily find the shortest path, but is usually within a few
+       percent of it, and is fast enough for a few thousand points.
+
+    Parameters
+    ----------
+    points : npt.ArrayLike
+        The (N, n_axes) array of points to visit.
+    weights : npt.ArrayLike, optional
+        The cost per unit of travel along each axis, see `travel_costs`.
+        By default 1 for every axis.
+    start : npt.ArrayLike, optional
+        The position the path starts from, e.g. the current stage position.
+        By default, the path starts at the first point.
+    max_passes : int, optional
+        The maximum number of 2-opt passes over the path, by default 20.
+
+    Returns
+    -------
+    np.ndarray[int]
+        The indices of `points` in the order they should be visited.
+    """
+    points = np.atleast_2d(np.asarray(points, dtype=float))
+    n = points.shape[0]
+    weights = np.ones(points.shape[1]) if weights is None else np.asarray(weights, dtype=float)
+    if n < 2:
+        return np.arange(n)
+    # A fixed starting position is treated as an extra point that can't be moved.
+    if start is not None:
+        points = np.concatenate((np.atleast_2d(start), points))
+    n_total = points.shape[0]
+
+    # Nearest neighbour tour
+    route = np.empty(n_total, dtype=int)
+    route[0] = 0
+    visited = np.zeros(n_total, dtype=bool)
+    visited[0] = True
+    for k in range(1, n_total):
+        costs = travel_costs(points[route[k-1]], points, weights)
+        costs[visited] = np.inf
+        route[k] = np.argmin(costs)
+        visited[route[k]] = True
+
+    # 2-opt, reversing route[i+1:j+1] replaces the moves i->i+1 and j->j+1
+    # with i->j and i+1->j+1, the moves in between are just run backwards.
+    for _ in range(max_passes):
+        improved = False
+        for i in range(n_total - 2):
+            a = points[route[i]]
+            b = points[route[i+1]]
+            cs = points[route[i+2:]]
+            delta = travel_costs(a, cs, weights) - travel_costs(a, b, weights)
+            ds = points[route[i+3:]]
+            delta[:-1] += travel_costs(b, ds, weights) - travel_costs(cs[:-1], ds, weights)
+            j = np.argmin(delta)
+            if delta[j] < -1E-12:
+                route[i+1:i+j+3] = route[i+1:i+j+3][::-1]
+                improved = True
+        if not improved:
+            break
+
+    if start is not None:
+        return route[1:] - 1
+    return route
+
+class PointScanner():
+    """Class for running a function at an arbitrary list of points, rather than on a grid,
+       e.g. for revisiting a list of candidate resonances, or only part of a grid.
+       Since moving between points is usually what takes time, the points can be visited in
+       an order that minimizes the total travel, weighted by how slow each axis is.
+       The estimated travel and time of the scan are reported before starting.
+
+        Parameters (for __init__)
+        ----------
+        function : Callable
+            The function to be called at each point, must only take in the
+            parameters as input, see `Scanner`.
+        points : npt.ArrayLike
+            The (N, n_params) array of points to visit.
+        weights : list[float], optional
+            How long it takes to move by one unit along each axis, e.g. seconds per micron.
+            Used both to optimize the order, and estimate the time taken to move.
+            By default 1 for every axis.
+        optimize : bool, optional
+            Whether to reorder the points to minimize travel, otherwise they're visited
+            in the order given. By default True
+        start : list[float], optional
+            Where the hardware is when the scan starts, by default the first point.
+        point_time : float, optional
+            How long it takes to measure each point, only used to estimate the time
+            taken by the scan. By default 0
+        output_dtype : npt.DTypeLike, optional
+            The type of output generated by the function, see `Scanner`. By default object
+        labels : list[], optional
+            A list of labels to call each axis, see `Scanner`. By default None.
+        init : Callable, optional
+            Run once before starting the sweep, see `Scanner`.
+        abort : Callable, optional
+            Checked after every point, see `Scanner`. The index is a tuple containing
+            the index of the point in the list of points.
+        progress : Callable, optional
+            Run after every point, see `Scanner`, with the same index as `abort`.
+        finish : Callable, optional
+            Run once after the sweep finishes, see `Scanner`. The results are in the
+            order the points were given, not the order they were visited.
+    """
+    def __init__(self, function : Callable,
+                 points : npt.ArrayLike,
+                 weights : list[float] = None,
+                 optimize : bool = True,
+                 start : list[float] = None,
+                 point_time : float = 0,
+                 output_dtype: npt.DTypeLike = object,
+                 labels : list[object] = None,
+                 init:Callable = lambda *args: None,
+                 abort:Callable = lambda *args: False,
+                 progress:Callable = lambda *args: None,
+                 finish:Callable= lambda *args: None) -> None:
+        self._n_params = len(signature(function).parameters)
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        if points.shape[1] != self._n_params:
+            raise RuntimeError("Number of coordinates doesn't match number of function parameters")
+        if weights is None:
+            weights = np.ones(self._n_params)
+        weights = np.atleast_1d(np.asarray(weights, dtype=float))
+        if len(weights) != self._n_params:
+            raise RuntimeError("Number of weights doesn't match number of function parameters")
+        if labels is not None and len(labels) != self._n_params:
+            raise RuntimeError("Number of labels doesn't match number of function parameters")
+        _check_n_params(init, 0, "Init function must take no parameters.")
+        _check_n_params(abort, 5, "Abort function must take 5 parameters (i, imax, index, pos, result).")
+        _check_n_params(progress, 5, "Progress function must take 5 parameters (i, imax, index, pos, result).")
+        _check_n_params(finish, 2, "Finish function must take 2 parameters (results, completed).")
+
+        self._func : Callable = function
+        self._points : npt.NDArray = points
+        self._weights : npt.NDArray = weights
+        self._start = None if start is None else np.asarray(start, dtype=float)
+        self._point_time = point_time
+        self._dtype : npt.DTypeLike = output_dtype
+        self.labels = [str(label) for label in labels] if labels else [str(i) for i in range(self._n_params)]
+        self._init_func = init
+        self._abort_func = abort
+        self._prog_func = progress
+        self._finish_func = finish
+
+        self._has_run = False
+        if optimize:
+            self.order = order_points(points, weights, self._start)
+        else:
+            self.order = np.arange(points.shape[0])
+
+    @property
+    def points(self) -> npt.NDArray:
+        """The (N, n_params) array of points to visit, in the order they were given."""
+        return self._points
+
+    def estimate(self) -> dict[str, object]:
+        """Estimate the travel along each axis and total time taken by the scan,
+           when visiting the points in the current `order`.
+
+        Returns
+        -------
+        dict[str, object]
+            'travel' : np.ndarray[float], the total distance travelled along each axis.
+            'move_time' : float, the time spent moving, from the weights.
+            'time' : float, the total time, including point_time for every point.
+        """
+        path = self._points[self.order]
+        if self._start is not None:
+            path = np.concatenate((np.atleast_2d(self._start), path))
+        travel = np.sum(np.abs(np.diff(path, axis=0)), axis=0)
+        move_time = float(np.sum(travel * self._weights))
+        return {"travel" : travel,
+                "move_time" : move_time,
+                "time" : move_time + self._point_time * len(self.order)}
+
+    def run(self):
+        """Run the scan. After reporting the estimated travel and time of the scan, runs the
+        provided initialization function, then visits every point in `order`, running the
+        provided function, saving the results, followed by the progress function.
+        Once done the provided finish function is run, and finally the results are returned.
+
+        Returns
+        -------
+        np.ndarray[npt.DTypeLike]
+            The results of running the function at each point, in the order the points were given.
+        """
+        estimate = self.estimate()
+        travel = ", ".join(f"{label}: {dist:g}" for label, dist in zip(self.labels, estimate['travel']))
+        print(f"Scanning {len(self.order)} points, travelling {travel}. "
+              f"Estimated time: {estimate['time']:.1f}s ({estimate['move_time']:.1f}s moving).")
+
+        results = np.zeros(len(self.order), dtype=self._dtype)
+        self.results = results
+        self._has_run = True
+        return _sweep(self._run_points, results, self._init_func, self._finish_func)
+
+    def _run_points(self):
+        """Visit every point in `order`, see `run`.
+
+        Returns
+        -------
+        bool
+            Whether the scan fully completed.
+        bool
+            Whether the abort function requested to stop the scan.
+        """
+        Imax = len(self.order)
+        for I, k in enumerate(self.order):
+            index = (int(k),)
+            position = tuple(self._points[k])
+            result = self._func(*position)
+            self.results[k] = result
+            if self._abort_func(I,Imax,index,position,result):
+                return False, True
+            self._prog_func(I, Imax, index, position, result)
+        return True, False
+
+    def run_async(self):
+        """Runs the scan as described in `run()`, but does it in a new thread,
+           see `Scanner.run_async`.
+
+        Returns
+        -------
+        threading.Thread
+            The thread object in which the scan was run.
+        """
+        return _run_async(self.run)
+
+    def save_results(self, filename : str, as_npz : bool=False, header:str=""):
+        """Saves the results from the most recent run, with one row per point containing
+        its position and result, in the order the points were given. See `Scanner.save_results`
+        for details on the format. The npz archive also contains the order the points were
+        visited in as 'order'.
+
+        Parameters
+        ----------
+        filename : str
+            The path to the file to be saved, without an extension.
+        as_npz : bool, optional
+            If true the data will be saved as a binary numpy array archive.
+            By default False
+        header : str, optional
+            Additional data to be saved with the file. By default ""
+        """
+        if isinstance(filename, str):
+            filename = Path(filename)
+        filename = _safe_file_name(filename)
+        if not self._has_run:
+            raise RuntimeError("Scan must be run before saving results")
+
+        if self._dtype is object and not as_npz:
+            warn("object arrays must be saved as npz, forcing as_npz = True")
+            as_npz = True
+
+        if as_npz:
+            np.savez(filename, res=self.results,
+                               pos=self._points,
+                               order=self.order,
+                               head=np.array(header))
+        else:
+            with open(filename.with_suffix(".csv"), 'w') as f:
+                nline = len(header.split('\n')) + 2
+                f.write(f"n_header_lines = {nline}\n")
+                f.write(header)
+                f.write("\n")
+                f.write(", ".join(self.labels) + ", value\n")
+                np.savetxt(f, np.column_stack((self._points, self.results)),
+                           fmt="%.17g", delimiter=", ")
@@ -1,14 +1,20 @@
 import numpy as np
-import itertools
+import numpy.typing as npt
+from collections import OrderedDict
+from threading import Lock
 config = {"dio_chns" : 16,
           "user_dio_chns" : 14,
           "counter_dio_chn" : 0,
           "gate_dio_chn" : 1,
           "pause_time" : 1E-6,
           "clock_rate" : 120E6,
-          "max_ticks" : np.iinfo(np.uint16).max}
+          "max_ticks" : np.iinfo(np.uint16).max,
+          "cache_size" : 64,
+          "compress" : True}
 
 class PulseGen():
+    # Longest sequence cached by the values in its dicts, rather than converting it to arrays.
+    _max_key_steps = 16
 
     def __init__(self, config):
         self.cr = config['clock_rate']
@@ -21,6 +27,15 @@ class PulseGen():
         self.counter = config['counter_dio_chn']
         self.gate = config['gate_dio_chn']
 
+        # Whether compiled sequences are run-length compressed, see `compress`.
+        self.compress_sequences = config.get('compress', True)
+        # Cache of compiled sequences, most recently used last.
+        self.cache_size = config.get('cache_size', 64)
+        self._cache = OrderedDict()
+        self._cache_lock = Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
     def bin_to_int(self, array):
         total = 0
         for idx, val in enumerate(array):
@@ -45,21 +60,231 @@ class PulseGen():
             ticks = np.array([r])
         return ticks.astype(np.uint16)
 
+    def split_durations(self, durations : npt.ArrayLike) -> tuple[npt.NDArray, npt.NDArray]:
+        """Vectorised `split_time`, splitting the duration of every step (in ms)
+        into words of at most `max_ticks` ticks.
+
+        Returns
+        -------
+        np.ndarray[np.uint32]
+            The ticks of every word, for all steps one after the other.
+        np.ndarray[int]
+            The number of words used by each step.
+        """
+        total = np.round(np.asarray(durations, dtype=float) * 1E-3 * self.cr).astype(np.int64)
+        return self._split_ticks(total)
+
+    def _split_ticks(self, total : npt.NDArray[np.int64]) -> tuple[npt.NDArray, npt.NDArray]:
+        if np.all(total < self.mt):
+            # Usual case, where nothing needs splitting
+            return total.astype(np.uint32), np.ones(len(total), dtype=np.int64)
+        q, r = np.divmod(total, self.mt)
+        n_words = np.where(q > 0, q + (r != 0), 1)
+        ticks = np.full(np.sum(n_words), self.mt, dtype=np.uint32)
+        ticks[np.cumsum(n_words) - 1] = np.where((q > 0) & (r == 0), self.mt, r)
+        return ticks, n_words
+
+    def dio_masks(self, dio : npt.ArrayLike) -> npt.NDArray[np.uint32]:
+        """Pack every row of a (N, n_dio) array of dio states into the upper 16 bits of a word."""
+        dio = np.asarray(dio, dtype=bool)
+        if dio.shape[-1] > 32 - 16:
+            raise ValueError(f"At most 16 dio channels can be packed, got {dio.shape[-1]}")
+        if dio.shape[-1] < 16:
+            dio = np.concatenate((dio, np.zeros(dio.shape[:-1] + (16 - dio.shape[-1],), dtype=bool)), axis=-1)
+        # Each row packs into 2 bytes, first channel in the lowest bit
+        packed = np.packbits(np.ascontiguousarray(dio).reshape(-1), bitorder='little')
+        return packed.view('<u2').reshape(dio.shape[:-1]).astype(np.uint32) << np.uint32(16)
+
+    def encode(self, durations : npt.ArrayLike, dio : npt.ArrayLike) -> npt.NDArray[np.uint32]:
+        """Encode N steps given as arrays into fifo words, same as calling `parse_step`
+        on each of them, but done over the whole arrays at once.
+
+        Parameters
+        ----------
+        durations : npt.ArrayLike
+            The N step durations in ms.
+        dio : npt.ArrayLike
+            The (N, n_dio) array of dio states during each step,
+            including the counter and gate channels.
+
+        Returns
+        -------
+        np.ndarray[np.uint32]
+            The fifo words, with long steps split over multiple words.
+        """
+        ticks, n_words = self.split_durations(durations)
+        return ticks | np.repeat(self.dio_masks(dio), n_words)
+
+    def encode_sequence(self, durations : npt.ArrayLike, dio : npt.ArrayLike) -> npt.NDArray[np.uint32]:
+        """Same as `encode`, with the pauses added at the start and end of the sequence
+        like `parse_sequence`.
+        """
+        pause_ticks = int(round(self.pt * self.cr))
+        words = self.encode(durations, dio)
+        return np.concatenate(([pause_ticks], words, [pause_ticks])).astype(np.uint32)
+
+    def decode(self, words : npt.ArrayLike) -> tuple[npt.NDArray, npt.NDArray]:
+        """Split fifo words back into their tick counts and (N, n_dio) dio states."""
+        words = np.asarray(words, dtype=np.uint32)
+        ticks = words & 0xFFFF
+        shifts = np.arange(16, 16 + self.dchns, dtype=np.uint32)
+        dio = ((words[:,None] >> shifts) & 1).astype(np.uint8)
+        return ticks, dio
+
+    def decode_sequence(self, words : npt.ArrayLike) -> list[dict[str, object]]:
+        """Turn the fifo data of a sequence back into a list of steps, for checking what
+        was actually sent. The pauses at either end are dropped, and words that were
+        split from a single step by `split_durations` are joined back together.
+        A step of exactly `max_ticks` followed by a step with the same dio states
+        can't be told apart from a single longer step, so it's also joined,
+        which encodes to the same words.
+        """
+        ticks, dio = self.decode(np.asarray(words, dtype=np.uint32)[1:-1])
+        if len(ticks) == 0:
+            return []
+        continued = (ticks[:-1] == self.mt) & np.all(dio[1:] == dio[:-1], axis=1)
+        starts = np.flatnonzero(np.concatenate(([True], ~continued)))
+        durations = np.add.reduceat(ticks.astype(np.int64), starts) / self.cr * 1E3
+        return [{'duration' : float(duration), 'dio_array' : dio_array.tolist()}
+                for duration, dio_array in zip(durations, dio[starts])]
+
+    def compress(self, words : npt.ArrayLike) -> npt.NDArray[np.uint32]:
+        """Run-length compress the fifo data of a sequence. Adjacent words with the same
+        dio states, whether from consecutive steps or split from a long step, are merged
+        into a single run, which is then split into as few words as possible.
+        The outputs stay in every state for exactly the same number of ticks, so the
+        generated pattern is unchanged, including every gate window, only fewer words
+        need to be uploaded. The pauses at either end are left as is.
+
+        Parameters
+        ----------
+        words : npt.ArrayLike
+            The fifo data of a sequence, as returned by `parse_sequence`.
+
+        Returns
+        -------
+        np.ndarray[np.uint32]
+            The compressed fifo data.
+        """
+        words = np.asarray(words, dtype=np.uint32)
+        body = words[1:-1]
+        if len(body) == 0:
+            return words.copy()
+        masks = body & np.uint32(0xFFFF0000)
+        starts = np.flatnonzero(np.concatenate(([True], masks[1:] != masks[:-1])))
+        if len(starts) == len(body):
+            return words.copy()
+        totals = np.add.reduceat((body & 0xFFFF).astype(np.int64), starts)
+        ticks, n_words = self._split_ticks(totals)
+        body = ticks | np.repeat(masks[starts], n_words)
+        return np.concatenate((words[:1], body, words[-1:]))
+
+    def count_windows(self, words : npt.ArrayLike) -> int:
+        """The number of gate windows in the fifo data of a sequence, i.e. how many
+        times the gate channel turns on, which is how many counts the sequence produces.
+        """
+        gate = (np.asarray(words, dtype=np.uint32) >> (16 + self.gate)) & 1
+        return int(gate[0] + np.count_nonzero(gate[1:] > gate[:-1])) if len(gate) else 0
+
+    def upload_cost(self, words : npt.ArrayLike) -> dict[str, int]:
+        """The size of the fifo data of a sequence, as the number of fifo words
+        and the number of bytes transferred when uploading it.
+        """
+        n_words = len(words)
+        return {"words" : n_words,
+                "bytes" : n_words * np.dtype(np.uint32).itemsize}
+
     def parse_step(self, step : dict[str, object]):
-        time = step['duration'] * 1E-3
-        ticks = self.split_time(time)
-        values = []
-        for tick in ticks:
-            binary_time = self.int_to_bin(tick)
-            # Pad binary tick count to a length of 16 
-            binary_time += [0] * (16 - len(binary_time))
-            full_binary = binary_time + step['dio_array']
-            values.append(self.bin_to_int(full_binary))
-        return values
-    
+        return self.encode([step['duration']], [step['dio_array']]).tolist()
+
     def parse_sequence(self, steps : list[dict[str, object]]):
-        pause_ticks = int(round(self.pt * self.cr)) 
-        values = list(map(self.parse_step,steps))
-        values.append([pause_ticks])
-        flat = list(itertools.chain.from_iterable(values))
-        return np.append([pause_ticks],flat)
+        return self.encode_sequence(*self.sequence_arrays(steps))
+
+    def sequence_arrays(self, steps : list[dict[str, object]]) -> tuple[npt.NDArray, npt.NDArray]:
+        """The durations and (N, n_dio) dio states of a sequence of steps, as arrays
+        that are equal for any two sequences that compile to the same fifo data,
+        regardless of the types used in the dicts.
+        """
+        durations = np.array([step['duration'] for step in steps], dtype=float)
+        rows = [step['dio_array'] for step in steps]
+        if not rows:
+            return durations, np.zeros((0, self.dchns), dtype=bool)
+        try:
+            # Much faster than converting every state on its own, as long as they're
+            # all 0/1 ints or bools, and every step has the same number of channels.
+            if len(set(map(len, rows))) != 1:
+                raise ValueError
+            dio = np.frombuffer(b"".join(map(bytes, rows)), dtype=np.uint8)
+            dio = dio.reshape(len(rows), len(rows[0]))
+        except (TypeError, ValueError):
+            dio = np.asarray(rows)
+        return durations, dio.astype(bool)
+
+    def compile_sequence(self, steps : list[dict[str, object]]) -> np.ndarray:
+        """Same as `parse_sequence`, but returns a read-only uint32 array ready to be
+        written to the pulse pattern fifo, compressed if `compress` is set in the config, and keeps
+        the last `cache_size` compiled sequences so that repeated sequences are only encoded once.
+        Short sequences, up to `_max_key_steps` steps, are looked up by the values in their dicts
+        directly, longer ones are first converted to arrays, see `compile_arrays`.
+        """
+        if len(steps) > self._max_key_steps:
+            return self.compile_arrays(*self.sequence_arrays(steps))
+        try:
+            key = (self.compress_sequences, 
+                   tuple((step['duration'], tuple(step['dio_array'])) for step in steps))
+            data = self._cache_get(key)
+        except TypeError:
+            # Unhashable values in the dicts
+            return self.compile_arrays(*self.sequence_arrays(steps))
+        if data is None:
+            data = self._compile(key, *self.sequence_arrays(steps))
+        return data
+
+    def compile_arrays(self, durations : npt.ArrayLike, dio : npt.ArrayLike) -> np.ndarray:
+        """Same as `compile_sequence`, but for a sequence already given as the arrays 
+        of its N step durations in ms and (N, n_dio) dio states, as taken by `encode`, 
+        which is much faster for long sequences, since no work is done per step.
+        """
+        durations = np.asarray(durations, dtype=float)
+        dio = np.asarray(dio, dtype=bool)
+        key = (self.compress_sequences, durations.tobytes(), dio.shape, dio.tobytes())
+        data = self._cache_get(key)
+        if data is None:
+            data = self._compile(key, durations, dio)
+        return data
+
+    def _cache_get(self, key : tuple) -> np.ndarray:
+        with self._cache_lock:
+            data = self._cache.get(key)
+            if data is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+            return data
+
+    def _compile(self, key : tuple, durations : npt.NDArray, dio : npt.NDArray) -> np.ndarray:
+        data = self.encode_sequence(durations, dio)
+        if self.compress_sequences:
+            data = self.compress(data)
+        data.flags.writeable = False
+
+        with self._cache_lock:
+            self._cache[key] = data
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return data
+
+    def cache_stats(self) -> dict[str, int]:
+        """Hits, misses and current size of the compiled sequence cache."""
+        with self._cache_lock:
+            return {"hits" : self.cache_hits,
+                    "misses" : self.cache_misses,
+                    "size" : len(self._cache),
+                    "capacity" : self.cache_size}
+
+    def clear_cache(self) -> None:
+        with self._cache_lock:
+            self._cache.clear()
+            self.cache_hits = 0
+            self.cache_misses = 0
@@ -0,0 +1,138 @@
+import json
+import os
+import numpy as np
+import numpy.typing as npt
+from pathlib import Path
+from typing import Union
+
+class ResultStore():
+    """Memory mapped on-disk store for the results of a scan.
+       The results are kept in a `.npy` file shaped like the scan grid with a fixed
+       per-point shape and dtype, so they can be loaded back with `numpy.load`.
+       Points are appended one at a time in the order they are measured, and
+       every `chunk_size` points the memory map is flushed to disk and the number
+       of committed points is recorded in a small `.json` file next to it.
+       This keeps the memory used by a scan bounded, and if the scan crashes,
+       at most one chunk of points is lost.
+
+        Parameters (for __init__)
+        ----------
+        filename : Union[str, Path]
+            The path to the store, the extension will be replaced by `.npy` for the
+            data and `.json` for the bookkeeping.
+        shape : tuple[int]
+            The shape of the scan grid, i.e. the number of steps along each axis.
+        point_shape : tuple[int], optional
+            The shape of the result at every point, by default () for a single number.
+        dtype : npt.DTypeLike, optional
+            The type of the results, must be a fixed size type, by default float.
+        chunk_size : int, optional
+            How many points to append between each flush to disk, by default 64.
+    """
+    def __init__(self, filename : Union[str, Path], shape : tuple[int],
+                 point_shape : tuple[int] = (), dtype : npt.DTypeLike = float,
+                 chunk_size : int = 64) -> None:
+        dtype = np.dtype(dtype)
+        if dtype.hasobject:
+            raise ValueError("ResultStore requires a fixed size dtype, not object.")
+        if chunk_size < 1:
+            raise ValueError("Chunk size must be at least 1.")
+        filename = Path(filename)
+        self.filename = filename.with_suffix(".npy")
+        self.meta_filename = filename.with_suffix(".json")
+        self.shape = tuple(int(n) for n in shape)
+        self.point_shape = tuple(int(n) for n in point_shape)
+        self.chunk_size = int(chunk_size)
+
+        self._data = np.lib.format.open_memmap(self.filename, mode='w+', dtype=dtype,
+                                               shape=self.shape + self.point_shape)
+        self._n_written = 0
+        self._n_committed = 0
+        self._write_meta()
+
+    @classmethod
+    def open(cls, filename : Union[str, Path], mode : str = 'r+') -> "ResultStore":
+        """Reopen an existing store, i.e. after a crash or to read the results.
+
+        Parameters
+        ----------
+        filename : Union[str, Path]
+            The path to the store, with or without extension.
+        mode : str, optional
+            The mode to open the memory map with, 'r' for read only,
+            or 'r+' to keep appending. By default 'r+'
+
+        Returns
+        -------
+        ResultStore
+            The store, containing only the points committed before it was last closed.
+        """
+        filename = Path(filename)
+        store = cls.__new__(cls)
+        store.filename = filename.with_suffix(".npy")
+        store.meta_filename = filename.with_suffix(".json")
+        with open(store.meta_filename, 'r') as f:
+            meta = json.load(f)
+        store.shape = tuple(meta['shape'])
+        store.point_shape = tuple(meta['point_shape'])
+        store.chunk_size = meta['chunk_size']
+        store._data = np.load(store.filename, mmap_mode=mode)
+        store._n_written = meta['n_committed']
+        store._n_committed = meta['n_committed']
+        return store
+
+    @property
+    def data(self) -> np.memmap:
+        """The memory mapped results, shaped as `shape + point_shape`."""
+        return self._data
+
+    @property
+    def n_written(self) -> int:
+        """The number of points appended so far."""
+        return self._n_written
+
+    @property
+    def n_committed(self) -> int:
+        """The number of points that are safely flushed to disk."""
+        return self._n_committed
+
+    def append(self, index : tuple[int], value : object) -> None:
+        """Store the result of the next point of the scan, flushing to disk
+           if a full chunk has been appended since the last flush.
+
+        Parameters
+        ----------
+        index : tuple[int]
+            The index of the point in the scan grid.
+        value : object
+            The result at that point, must be castable to `point_shape` and `dtype`.
+        """
+        self._data[index] = value
+        self._n_written += 1
+        if self._n_written - self._n_committed >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write all appended points to disk and commit them."""
+        self._data.flush()
+        self._n_committed = self._n_written
+        self._write_meta()
+
+    def close(self) -> None:
+        """Flush any remaining points to disk."""
+        if self._data.mode != 'r':
+            self.flush()
+
+    def _write_meta(self) -> None:
+        """Atomically replace the bookkeeping file, so that it's never left
+           half written if the scan crashes.
+        """
+        meta = {"shape" : self.shape,
+                "point_shape" : self.point_shape,
+                "dtype" : self._data.dtype.str,
+                "chunk_size" : self.chunk_size,
+                "n_committed" : self._n_committed}
+        tmp = self.meta_filename.with_suffix(".json.tmp")
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.meta_filename)
@@ -1,11 +1,17 @@
-from typing import Callable
+from typing import Callable, Union
 import numpy as np
 import numpy.typing as npt
 from inspect import signature
 from numbers import Number
 from warnings import warn
 from pathlib import Path
-from threading import Thread
+from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from itertools import product
+from time import perf_counter
+import os
+from scan_store import ResultStore
 
 class Scanner():
     """Class for running a function with parameters swept over a grid. 
@@ -155,34 +161,14 @@ class Scanner():
             if not (0 < i <= self._n_params - 1):
                 raise RuntimeError(f"Invalid axis to snake: {i}")
         for i in log:
-            if not log <= self._n_params - 1:
+            if not i <= self._n_params - 1:
                 raise RuntimeError(f"Invalid axis to logarithmic {i}")
 
         # If values of parameters is wrong, and the function doesn't take an arbitrary length *args.
-        if len(signature(init).parameters) != 0:
-            if list(signature(init).parameters.values())[0].kind != 2:
-                raise RuntimeError("Progress function must take no parameters.")
-        if len(signature(abort).parameters) != 5:
-            msg = "Abort function must take 5 parameters (i, imax, index, pos, result)."
-            try:
-                if list(signature(abort).parameters.values())[0].kind != 2:
-                    raise RuntimeError(msg)
-            except IndexError:
-                raise RuntimeError(msg)
-        if len(signature(progress).parameters) != 5:
-            msg = "Progress function must take 5 parameters (i, imax, index, pos, result)."
-            try:
-                if list(signature(progress).parameters.values())[0].kind != 2:
-                    raise RuntimeError(msg)
-            except IndexError:
-                raise RuntimeError(msg)
-        if len(signature(finish).parameters) != 2:
-            msg = "Finish function must take 2 parameters (results, completed)."
-            try:
-                if list(signature(finish).parameters.values())[0].kind != 2:
-                    raise RuntimeError(msg)
-            except IndexError:
-                raise RuntimeError(msg)
+        _check_n_params(init, 0, "Init function must take no parameters.")
+        _check_n_params(abort, 5, "Abort function must take 5 parameters (i, imax, index, pos, result).")
+        _check_n_params(progress, 5, "Progress function must take 5 parameters (i, imax, index, pos, result).")
+        _check_n_params(finish, 2, "Finish function must take 2 parameters (results, completed).")
 
         self._func : Callable = function
 
@@ -199,6 +185,15 @@ class Scanner():
         self._finish_func = finish
 
         self._has_run = False
+        self._store_config = None
+        self._checkpoint_config = None
+        self._pipeline_config = None
+        self._batched = False
+        self._mask_config = None
+        self._user_phases = []
+        self._timing = False
+        self.timings = None
+        self.store = None
 
         self._positions = self._get_positions()
 
@@ -419,38 +414,686 @@ class Scanner():
         Then, sweeps through all positions and runs the
         provided sweep function, saving the results, followed by the progress function.
         Once the sweep is completed the provided finish function is run, and finally the results
-        array is returned. 
+        array is returned. If `stream_to` was called, the results array is a memory map
+        of the file the results are streamed to.
+
+        Returns
+        -------
+        np.ndarray[npt.DTypeLike]
+            The results of running the sweep function at each position.
+        """
+        if self._store_config is not None:
+            filename, point_shape, chunk_size = self._store_config
+            store = ResultStore(_safe_file_name(filename.with_suffix(".npy")),
+                                self._steps, point_shape, self._dtype, chunk_size)
+            results = store.data
+        else:
+            store = None
+            results = np.zeros(self._steps, dtype=self._dtype)
+        self.timings = None
+        return self._run(0, results, store)
+
+    def resume(self, filename : str):
+        """Resume a scan from a checkpoint written while running with `checkpoint_to`.
+        The positions, snaking, labels, mask and results collected so far are loaded from
+        the checkpoint, and the sweep continues from the first step that wasn't completed,
+        visiting the remaining positions in the same order as the original scan.
+        The sweep function and init/abort/progress/finish functions are those of this
+        scanner, so they should match the ones used for the original scan. 
+        If the original scan was streamed to disk, the results keep being appended to
+        the same file.
+
+        Checkpoints will keep being written to the same file, unless `checkpoint_to`
+        was called to set up a different one.
+
+        Parameters
+        ----------
+        filename : str
+            The path to the checkpoint file.
+
+        Returns
+        -------
+        np.ndarray[npt.DTypeLike]
+            The results of running the sweep function at each position, including those
+            loaded from the checkpoint.
+        """
+        filename = Path(filename).with_suffix(".npz")
+        with np.load(filename, allow_pickle=True) as ckpt:
+            positions = [ckpt[f"pos{ax}"] for ax in range(len(ckpt["steps"]))]
+            if len(positions) != self._n_params:
+                raise RuntimeError("Number of axes in checkpoint doesn't match number of function parameters")
+            step = int(ckpt["step"])
+            every = int(ckpt["every"])
+            dtype = np.dtype(str(ckpt["dtype"]))
+            self._snake = [int(ax) for ax in ckpt["snake"]]
+            self._log = [int(ax) for ax in ckpt["log"]]
+            self.labels = [str(label) for label in ckpt["labels"]]
+            if "timings" in ckpt.files and list(ckpt["timing_phases"]) == self.timing_phases:
+                self.timings = np.copy(ckpt["timings"])
+            else:
+                self.timings = None
+            if "mask" in ckpt.files:
+                self._mask_config = (np.copy(ckpt["mask"]), ckpt["fill"].item())
+            if "store" in ckpt.files:
+                store = ResultStore.open(str(ckpt["store"]), mode='r+')
+                step = max(step, store.n_committed)
+                results = store.data
+            else:
+                store = None
+                results = np.copy(ckpt["results"])
+
+        self._dtype = object if dtype.hasobject else dtype
+        self._positions = positions
+        self._centers, self._spans, self._steps = (np.atleast_1d(values) for values 
+                                                   in self._get_centers_spans_steps())
+        if self._checkpoint_config is None:
+            self._checkpoint_config = (filename, every)
+        return self._run(step, results, store)
+
+    def _run(self, start : int, results : npt.NDArray, store : ResultStore):
+        """Sweep through all positions from step `start` onwards, see `run()`.
+
+        Parameters
+        ----------
+        start : int
+            The first step to run.
+        results : npt.NDArray
+            The array to store results in, already containing any results before `start`.
+        store : ResultStore
+            The store to append results to, or None if they're only kept in `results`.
 
         Returns
         -------
         np.ndarray[npt.DTypeLike]
             The results of running the sweep function at each position.
         """
-        Imax = np.prod(self._steps)
-        results = np.zeros(self._steps, dtype=self._dtype)
+        self.store = store
         self.results = results
         self._has_run = True
-        positions, indices = self.generate_scan_positions()
         self._prev_positions = self.positions
-        
-        self._init_func()
+        self._mask = self.get_mask()
+        if self._mask is None:
+            Imax = self.n_steps
+            self._n_measured = start
+        else:
+            Imax = int(np.count_nonzero(self._mask))
+            done = _scan_index(np.arange(start), self._steps, self._snake)
+            self._n_measured = int(np.count_nonzero(self._mask[done]))
+        self._phase_cols = {phase : col for col, phase in enumerate(self.timing_phases)}
+        if not self._timing:
+            self.timings = None
+        elif self.timings is None or self.timings.shape != (self.n_steps, len(self._phase_cols)):
+            self.timings = np.full((self.n_steps, len(self._phase_cols)), np.nan, dtype=np.float32)
+        self._marks = np.zeros(len(self._user_phases))
+        self._n_done = start
 
-        completed = False
+        if self._pipeline_config is not None:
+            loop = lambda: self._run_pipelined(start, Imax)
+        elif self._batched:
+            loop = lambda: self._run_batched(start, Imax)
+        else:
+            loop = lambda: self._run_points(start, Imax)
+
+        def cleanup():
+            if store is not None:
+                store.close()
+            if self._checkpoint_config is not None:
+                self._write_checkpoint(self._n_done)
+
+        return _sweep(loop, results, self._init_func, self._finish_func, cleanup)
+
+    def _run_points(self, start : int, Imax : int):
+        """Sweep through all positions from step `start` onwards, calling the sweep
+           function at every measured step, and saving the fill value at masked steps.
+
+        Returns
+        -------
+        bool
+            Whether the sweep fully completed.
+        bool
+            Whether the abort function requested to stop the scan.
+        """
+        mask = self._mask
+        for I, index, position in self.scan_positions(start):
+            if mask is not None and not mask[index]:
+                self._save_point(I, index, self._mask_config[1])
+                continue
+            result = self._call([I], position)
+            if self._complete_point(I, Imax, index, position, result):
+                return False, True
+        return True, False
+
+    def _run_batched(self, start : int, Imax : int):
+        """Sweep through all positions from step `start` onwards, calling the sweep
+           function once per line, see `batch_lines`.
+
+        Returns
+        -------
+        bool
+            Whether the sweep fully completed.
+        bool
+            Whether the abort function requested to stop the scan.
+        """
+        for points, args in self._acquisitions(start):
+            result = None if args is None else self._call(_measured_steps(points), args)
+            if self._complete_points(points, Imax, result):
+                return False, True
+        return True, False
+
+    def _acquisitions(self, start : int):
+        """Iterate over the calls to the sweep function needed to complete the scan
+           from step `start` onwards. Normally this is one call per step, but when batching
+           lines, it's one call per line of the last axis, with all the positions along it 
+           passed as an array, in the order they're visited. 
+           Masked steps are never passed to the sweep function, but are still covered by
+           the call following them, or by no call at all if nothing is left to measure.
+
+        Parameters
+        ----------
+        start : int
+            The first step to run.
+
+        Yields
+        ------
+        points : list[tuple[int, tuple[int], tuple[Number], bool]]
+            The step number, index and position of every step covered by the call, 
+            and whether it's measured or masked.
+        args : tuple
+            The arguments to call the sweep function with, or None if every step is masked.
+        """
+        mask = self._mask
+        if not self._batched:
+            skipped = []
+            for I, index, position in self.scan_positions(start):
+                if mask is not None and not mask[index]:
+                    skipped.append((I, index, position, False))
+                    continue
+                yield skipped + [(I, index, position, True)], position
+                skipped = []
+            if skipped:
+                yield skipped, None
+            return
+        n_line = int(self._steps[-1])
+        for I0 in range(start - start % n_line, self.n_steps, n_line):
+            Is = np.arange(max(I0, start), I0 + n_line)
+            index = _scan_index(Is, self._steps, self._snake)
+            positions = [self._positions[ax][idx] for ax, idx in enumerate(index)]
+            measured = np.ones(len(Is), dtype=bool) if mask is None else mask[index]
+            points = [(int(I), 
+                       tuple(int(idx[k]) for idx in index), 
+                       tuple(pos[k] for pos in positions),
+                       bool(measured[k]))
+                      for k, I in enumerate(Is)]
+            if np.any(measured):
+                yield points, tuple(pos[0] for pos in positions[:-1]) + (positions[-1][measured],)
+            else:
+                yield points, None
+
+    def _complete_points(self, points : list[tuple], Imax : int, result : object):
+        """Complete every step covered by a single call to the sweep function,
+           see `_complete_point`, filling in masked steps without running the
+           abort and progress functions.
+
+        Returns
+        -------
+        bool
+            Whether the abort function requested to stop the scan.
+        """
+        n_measured = sum(measured for *_, measured in points)
+        if n_measured == 0:
+            result = []
+        elif self._batched:
+            if len(result) != n_measured:
+                raise RuntimeError(f"Batched sweep function returned {len(result)} results "
+                                   f"for a line of {n_measured} positions.")
+        else:
+            result = [result]
+        result = iter(result)
+        for I, index, position, measured in points:
+            if measured:
+                if self._complete_point(I, Imax, index, position, next(result)):
+                    return True
+            else:
+                self._save_point(I, index, self._mask_config[1])
+        return False
+
+    def _save_point(self, I : int, index : tuple[int], result : object):
+        """Save the result of a single step, and write a checkpoint if one is due."""
+        if self.store is None:
+            self.results[index] = result
+        else:
+            self.store.append(index, result)
+        self._n_done = I + 1
+        if self._checkpoint_config is not None and not self._n_done % self._checkpoint_config[1]:
+            self._write_checkpoint(self._n_done)
+
+    def _call(self, rows : list[int], args : tuple):
+        """Run the sweep function for a single acquisition measuring the steps `rows`.
+           If timings are recorded, also time how long it took, as well as any phases
+           marked from within it with `mark`.
+        """
+        if self.timings is None:
+            return self._func(*args)
+        self._marks[:] = 0
+        start = self._lap = perf_counter()
+        result = self._func(*args)
+        elapsed = perf_counter() - start
+        self._record_timing(rows, self._phase_cols['function'], elapsed)
+        if len(self._marks):
+            self.timings[rows, :len(self._marks)] = self._marks / len(rows)
+        return result
+
+    def _record_timing(self, rows : list[int], col : int, elapsed : float):
+        """Split the time taken by an acquisition evenly between the steps it measured."""
+        if self.timings is None:
+            return
+        if len(rows) == 1:
+            self.timings[rows[0], col] = elapsed
+        else:
+            self.timings[rows, col] = elapsed / len(rows)
+
+    def mark(self, phase : str):
+        """Mark the end of a phase of the sweep function, e.g. moving the hardware or
+           waiting for it to settle, to be recorded in `timings`. This should be called
+           from within the sweep function, and records the time since the sweep function
+           started, or since the previous mark. The phases must first be declared with 
+           `set_timing_phases`. Does nothing unless timings are recorded, see `record_timings`.
+
+        Parameters
+        ----------
+        phase : str
+            The name of the phase that just ended.
+        """
+        if self.timings is None:
+            return
+        now = perf_counter()
         try:
-            for I,(index,position) in enumerate(zip(zip(*indices),zip(*positions))):
-                result = self._func(*position)
-                results[index] = result
-                if self._abort_func(I,Imax,index,position,result):
-                    return results
-                self._prog_func(I, Imax, index, position, result)
+            self._marks[self._phase_cols[phase]] += now - self._lap
+        except (KeyError, IndexError):
+            raise RuntimeError(f"Unknown timing phase: {phase}, declare it with set_timing_phases.")
+        self._lap = now
+
+    def _complete_point(self, I : int, Imax : int, index : tuple[int], 
+                        position : tuple[Number], result : object):
+        """Save the result of a single step and write a checkpoint if one is due,
+           then run the abort and progress functions. The abort and progress functions are
+           given the number of measured points so far rather than the step number,
+           so that masked steps aren't counted.
+
+        Returns
+        -------
+        bool
+            Whether the abort function requested to stop the scan.
+        """
+        n = self._n_measured
+        self._n_measured += 1
+        if self.timings is None:
+            self._save_point(I, index, result)
+            if self._abort_func(n,Imax,index,position,result):
+                return True
+            self._prog_func(n, Imax, index, position, result)
+            return False
+
+        cols = self._phase_cols
+        t_start = perf_counter()
+        self._save_point(I, index, result)
+        t_saved = perf_counter()
+        self.timings[I, cols['save']] = t_saved - t_start
+        if self._abort_func(n,Imax,index,position,result):
+            return True
+        t_checked = perf_counter()
+        self.timings[I, cols['abort']] = t_checked - t_saved
+        self._prog_func(n, Imax, index, position, result)
+        self.timings[I, cols['progress']] = perf_counter() - t_checked
+        return False
+
+    def _run_pipelined(self, start : int, Imax : int):
+        """Sweep through all positions from step `start` onwards, with the sweep function
+           run on this thread, and the process function run on a pool of worker threads.
+           A separate thread waits on the processed results in order, and saves them and
+           runs the abort and progress functions, so that the next point can be acquired
+           in the meantime.
+
+        Returns
+        -------
+        bool
+            Whether the sweep fully completed.
+        bool
+            Whether the abort function requested to stop the scan.
+        """
+        process, workers, depth = self._pipeline_config
+        pending = Queue(maxsize=depth)
+        stop = Event()
+        status = {"aborted" : False, "error" : None}
+
+        def finisher():
+            while (item := pending.get()) is not None:
+                if stop.is_set():
+                    # Drain the remaining points without saving them.
+                    continue
+                points, future = item
+                try:
+                    result = None
+                    if future is not None:
+                        result, elapsed = future.result()
+                        self._record_timing(_measured_steps(points), self._phase_cols['process'], elapsed)
+                    if self._complete_points(points, Imax, result):
+                        status["aborted"] = True
+                        stop.set()
+                except BaseException as e:
+                    status["error"] = e
+                    stop.set()
+
+        completed = False
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            thread = Thread(target=finisher)
+            thread.start()
+            try:
+                for points, args in self._acquisitions(start):
+                    if stop.is_set():
+                        break
+                    if args is None:
+                        pending.put((points, None))
+                        continue
+                    raw = self._call(_measured_steps(points), args)
+                    pending.put((points, pool.submit(_timed, process, raw)))
+                else:
+                    completed = True
+            finally:
+                pending.put(None)
+                thread.join()
+
+        if status["error"] is not None:
+            raise status["error"]
+        return completed and not stop.is_set(), status["aborted"]
+
+    def stream_to(self, filename : str, point_shape : tuple[int] = (), chunk_size : int = 64):
+        """Stream the results of following runs to a memory mapped file on disk
+           instead of holding them all in memory, see `scan_store.ResultStore`.
+           The output_dtype must then be a fixed size type, and every point
+           must return a result with the same shape.
+           Pass `None` as the filename to go back to keeping results in memory.
+
+        Parameters
+        ----------
+        filename : str
+            The path to the file to store results in, without an extension.
+            The path will be checked for an existing file with the same name, in which
+            case a number will be appended to avoid conflicts.
+        point_shape : tuple[int], optional
+            The shape of the result of every point, by default () for a single number.
+        chunk_size : int, optional
+            How many points are taken between each flush to disk, at most this many
+            points can be lost if the scan crashes. By default 64
+        """
+        if filename is None:
+            self._store_config = None
+            return
+        if np.dtype(self._dtype).hasobject:
+            raise RuntimeError("Results can only be streamed to disk with a fixed output_dtype.")
+        self._store_config = (Path(filename), tuple(point_shape), chunk_size)
+
+    def set_mask(self, mask : Union[npt.ArrayLike, Callable], fill : object = None):
+        """Only measure part of the grid in following runs. Masked steps are skipped
+           without calling the sweep function, and their result is set to `fill` instead.
+           The abort and progress functions are only run for measured steps, and are given
+           the number of measured steps so far, and the total number of measured steps,
+           instead of counting every step of the grid.
+           Pass `None` as the mask to measure every step again.
+
+        Parameters
+        ----------
+        mask : npt.ArrayLike | Callable
+            Either a boolean array shaped like the scan grid, true for the steps to measure,
+            or a function taking an array of positions for each axis, shaped like the scan grid, 
+            and returning such an array, e.g. `lambda x,y: (x**2 + y**2) < 1`.
+            A function is only evaluated when the scan is run, so it follows changes to the
+            positions.
+        fill : object, optional
+            The result saved for masked steps. By default nan for float outputs,
+            None for object outputs, and 0 otherwise.
+        """
+        if mask is None:
+            self._mask_config = None
+            return
+        if callable(mask):
+            _check_n_params(mask, self._n_params, 
+                            f"Mask function must take {self._n_params} parameters, one per axis.")
+        else:
+            mask = np.asarray(mask, dtype=bool)
+        if fill is None:
+            if np.dtype(self._dtype).hasobject:
+                fill = None
+            elif np.issubdtype(self._dtype, np.inexact):
+                fill = np.nan
             else:
-                completed = True
-        except KeyboardInterrupt:
-            warn("Caught Keyboard Intterup, aborting scan.")
-        
-        self._finish_func(results, completed)
+                fill = 0
+        self._mask_config = (mask, fill)
 
-        return results
+    def get_mask(self):
+        """Get the boolean array of which steps will be measured, see `set_mask`.
+
+        Returns
+        -------
+        np.ndarray[bool] | None
+            An array shaped like the scan grid, true for the steps to be measured,
+            or None if every step is measured.
+        """
+        if self._mask_config is None:
+            return None
+        mask = self._mask_config[0]
+        if callable(mask):
+            mask = mask(*np.meshgrid(*self._positions, indexing='ij'))
+        mask = np.broadcast_to(np.asarray(mask, dtype=bool), tuple(self._steps))
+        return mask
+
+    @property
+    def timing_phases(self):
+        """Get the name of every phase timed while running with `record_timings`, in the
+           order of the columns of `timings`. This is every phase declared with `set_timing_phases`,
+           followed by:
+              * function : the whole sweep function call, including any marked phases.
+              * process : the process function, when pipelined.
+              * save : saving the result.
+              * abort : the abort function.
+              * progress : the progress function.
+
+        Returns
+        -------
+        list[str]
+            The name of every phase.
+        """
+        return self._user_phases + ['function', 'process', 'save', 'abort', 'progress']
+
+    def record_timings(self, record : bool = True):
+        """Record how long every phase of every step takes in following runs, 
+           in `timings`, see `timing_phases`. Timings are then also saved in checkpoints,
+           and with the results. This costs a few microseconds per step, so it's
+           off by default.
+
+        Parameters
+        ----------
+        record : bool, optional
+            Whether to record timings, by default True
+        """
+        self._timing = bool(record)
+
+    def set_timing_phases(self, phases : list[str]):
+        """Declare phases of the sweep function to be timed, see `mark`.
+
+        Parameters
+        ----------
+        phases : list[str]
+            The name of each phase, e.g. ['move', 'settle', 'acquire'].
+        """
+        phases = [str(phase) for phase in phases]
+        for phase in phases:
+            if phase in ['function', 'process', 'save', 'abort', 'progress']:
+                raise RuntimeError(f"Timing phase {phase} is already timed by the scanner.")
+        self._user_phases = phases
+
+    def timing_summary(self):
+        """Summarize how long every phase of the most recent run took per step.
+           When batching lines, the time taken by the sweep and process functions
+           is split evenly between the points of the line.
+
+        Returns
+        -------
+        dict[str, dict[str, float]]
+            For every phase that was timed, a dictionary containing the number of steps
+            timed 'n', and the 'mean', 'std', 'median', 'max' and 'total' time in seconds.
+        """
+        if self.timings is None:
+            raise RuntimeError("No timings recorded, call record_timings before running the scan.")
+        summary = {}
+        for col, phase in enumerate(self.timing_phases):
+            times = self.timings[:, col]
+            times = times[~np.isnan(times)].astype(float)
+            if not len(times):
+                continue
+            summary[phase] = {"n" : len(times),
+                              "mean" : np.mean(times),
+                              "std" : np.std(times),
+                              "median" : np.median(times),
+                              "max" : np.max(times),
+                              "total" : np.sum(times)}
+        return summary
+
+    def timing_histogram(self, phase : str, bins : Union[int, npt.ArrayLike] = 50):
+        """Histogram of the time taken by a phase at every step of the most recent run.
+
+        Parameters
+        ----------
+        phase : str
+            The name of the phase, see `timing_phases`.
+        bins : int | npt.ArrayLike, optional
+            The number of bins, or the bin edges, see `numpy.histogram`. By default 50
+
+        Returns
+        -------
+        np.ndarray[int]
+            The number of steps in each bin.
+        np.ndarray[float]
+            The edges of the bins in seconds.
+        """
+        if self.timings is None:
+            raise RuntimeError("No timings recorded, call record_timings before running the scan.")
+        if phase not in self.timing_phases:
+            raise RuntimeError(f"Unknown timing phase: {phase}")
+        times = self.timings[:, self.timing_phases.index(phase)]
+        return np.histogram(times[~np.isnan(times)], bins)
+
+    def batch_lines(self, batched : bool = True):
+        """Hand whole lines of the last axis to the sweep function at once in following runs,
+           instead of calling it at every point. The last parameter of the sweep function
+           then receives a numpy array of every position along the line, in the order
+           they should be visited (i.e. reversed on every other line if the last axis is snaked),
+           and the function must return an array-like with one result per position, in the same order.
+           The other parameters are still single values. Results are still saved, and the 
+           abort and progress functions are still run, point by point.
+           If pipelined, the process function also receives and returns a whole line.
+
+        Parameters
+        ----------
+        batched : bool, optional
+            Whether to batch lines, by default True
+        """
+        self._batched = bool(batched)
+
+    def pipeline(self, process : Callable, workers : int = 1, depth : int = None):
+        """Split each step of following runs in two stages. The sweep function then only
+           moves the hardware and acquires the raw data, after which the next step
+           is started right away, while `process` turns the raw data into the result
+           on a pool of worker threads. Saving the results, the abort and progress functions 
+           are then run in order on a separate thread, so they also don't hold up the sweep.
+           Since the progress function is no longer run on the thread calling `run()`, it
+           should only do things which are safe outside of that thread.
+           Pass `None` as the process function to go back to running everything in sequence.
+
+        Parameters
+        ----------
+        process : Callable
+            A function that takes the output of the sweep function at a single point
+            and returns the result to be saved for that point. e.g. fitting a spectrum.
+        workers : int, optional
+            How many threads to run the process function on, by default 1.
+            Unless the process function releases the GIL, more than one is rarely useful.
+        depth : int, optional
+            How many acquired points can be waiting to be processed before
+            the sweep waits for them, bounding the memory used by raw data. 
+            By default 2 * workers.
+        """
+        if process is None:
+            self._pipeline_config = None
+            return
+        _check_n_params(process, 1, "Process function must take 1 parameter (raw).")
+        if workers < 1:
+            raise RuntimeError("Must use at least one worker.")
+        if depth is None:
+            depth = 2 * workers
+        self._pipeline_config = (process, int(workers), int(depth))
+
+    def checkpoint_to(self, filename : str, every : int = 100):
+        """Periodically save the progress of following runs to a checkpoint file, from which
+           an interrupted scan can be continued with `resume`. A checkpoint is also written
+           whenever the scan stops, whether it finished, was aborted or raised an error.
+           Pass `None` as the filename to stop checkpointing.
+
+           Unless the results are streamed to disk with `stream_to`, each checkpoint
+           contains a full copy of the results array, so `every` should be large enough
+           for saving not to slow down the scan.
+
+        Parameters
+        ----------
+        filename : str
+            The path to the checkpoint file, which is overwritten by every checkpoint.
+            Will be saved as a `.npz` numpy array archive.
+        every : int, optional
+            How many steps to take between each checkpoint, by default 100
+        """
+        if filename is None:
+            self._checkpoint_config = None
+            return
+        if every < 1:
+            raise RuntimeError("Must take at least one step between checkpoints.")
+        self._checkpoint_config = (Path(filename).with_suffix(".npz"), int(every))
+
+    def _write_checkpoint(self, step : int):
+        """Save everything needed to resume the current scan from `step` onwards.
+           The checkpoint is first written to a temporary file which then replaces
+           the previous checkpoint, so an interruption never leaves a corrupt checkpoint.
+
+        Parameters
+        ----------
+        step : int
+            The number of steps completed so far.
+        """
+        filename, every = self._checkpoint_config
+        data = {"step" : step,
+                "every" : every,
+                "steps" : np.array(self._steps, dtype=int),
+                "snake" : np.array(self._snake, dtype=int),
+                "log" : np.array(self._log, dtype=int),
+                "labels" : np.array(self.labels),
+                "dtype" : np.array(np.dtype(self._dtype).str)}
+        for ax, position in enumerate(self._prev_positions):
+            data[f"pos{ax}"] = position
+        if self.timings is not None:
+            data["timings"] = self.timings
+            data["timing_phases"] = np.array(self.timing_phases)
+        if self._mask is not None:
+            data["mask"] = self._mask
+            data["fill"] = np.array(self._mask_config[1], dtype=object)
+        if self.store is not None:
+            self.store.flush()
+            data["store"] = np.array(str(self.store.filename.resolve()))
+        else:
+            data["results"] = self.results
+
+        tmp = filename.with_suffix(".npz.tmp")
+        with open(tmp, 'wb') as f:
+            np.savez(f, **data)
+        os.replace(tmp, filename)
 
     def run_async(self):
         """Runs the sweep as described in `run()`, but does it in a new thread,
@@ -471,11 +1114,9 @@ class Scanner():
         threading.Thread
             The thread object in which the scan sweep was run.
         """
-        t = Thread(target=self.run)
-        t.start()
-        return t
+        return _run_async(self.run)
 
-    def save_results(self,filename : str, as_npz : bool=False, header:str=""):
+    def save_results(self,filename : str, as_npz : bool=False, header:str="", as_columns : bool=False):
         """Saves the results from the most recent running of the sweeper.
         If called before Sweeper.run(), an error will be raised.
 
@@ -506,6 +1147,14 @@ class Scanner():
             If saving as npz, this text be included as an additional array named 'header', 
             with no additional line info.
             By default ""
+        as_columns : bool, optional
+            If true, the same table as the csv is saved as a binary numpy array archive instead, 
+            with one array per column, named after each label, and the results named 'value', 
+            as well as the header named 'head'. This is the fast path for large scans: 
+            writing a csv means formatting every value as text, which takes around a
+            microsecond per value, i.e. over a second for a million points, while this
+            keeps the same layout and saves in a fraction of that. Ignored if as_npz is true.
+            By default False
         """
         if isinstance(filename, str):
             filename = Path(filename)
@@ -516,15 +1165,42 @@ class Scanner():
         if self._dtype is object and not as_npz:
             warn("object arrays must be saved as npz, forcing as_npz = True")
             as_npz = True
+        if np.ndim(self.results) > self._n_params and not as_npz:
+            warn("results with more than one value per point must be saved as npz, forcing as_npz = True")
+            as_npz = True
 
         results = self.results
         positions = self._prev_positions
+        timing_arrays = {}
+        if self.timings is not None:
+            timing_arrays = {"timing" : self.timings, "timing_phases" : np.array(self.timing_phases)}
         if as_npz:
             np.savez(filename, res=results, 
                                pos=np.array(positions),
-                               head=np.array(header))
+                               head=np.array(header),
+                               **timing_arrays)
+
+        elif as_columns:
+            # Full columns of the position along each axis at every step, in the
+            # same order as the flattened results.
+            grids = np.meshgrid(*positions, indexing='ij', copy=False)
+            columns = {label : grid.ravel() for label, grid in zip(self.labels, grids)}
+            if self.timings is not None:
+                # Timings are stored in the order steps were taken, reorder them like the results.
+                order = np.ravel_multi_index(_scan_index(np.arange(self.n_steps), self._steps, self._snake),
+                                             tuple(self._steps))
+                timings = np.empty_like(self.timings)
+                timings[order] = self.timings
+                for col, phase in enumerate(self.timing_phases):
+                    columns[f"timing_{phase}"] = timings[:, col]
+            np.savez(filename, value=np.ravel(results), head=np.array(header), **columns)
         
         else:
+            summary = self.timing_summary() if self.timings is not None else {}
+            if summary:
+                timing = "\n".join(f"timing {phase} = {t['mean']:.6g} s mean, {t['total']:.6g} s total"
+                                   for phase, t in summary.items())
+                header = f"{header}\n{timing}" if header else timing
             with open(filename.with_suffix(".csv"), 'w') as f:
                 if header != "" or header is not None:
                     nline = len(header.split('\n')) + 2
@@ -534,18 +1210,121 @@ class Scanner():
                 for label in self.labels:
                     f.write(f"{label}, ")
                 f.write(f"value\n")
-                for nindex, value in np.ndenumerate(results):
-                    pos = [positions[i][idx] for i,idx in enumerate(nindex)]
-                    for p in pos:
-                        f.write(f"{p}, ")
-                    f.write(f"{value}\n")
+                # Every row starts with the positions along each axis, so only format each
+                # position once. Rows are written in chunks spanning the last axes, up to
+                # 65536 rows, whose row starts are built once and reused for every position
+                # along the leading axes, in the same order as the flattened results.
+                strings = [[f"{p}, " for p in np.asarray(position).tolist()] for position in positions]
+                rows = [""]
+                split = len(strings)
+                while split == len(strings) or (split > 0 and len(rows) * len(strings[split-1]) <= 65536):
+                    split -= 1
+                    rows = [string + row for string in strings[split] for row in rows]
+                n_rows = len(rows)
+                values = np.ravel(results)
+                # Each line is made of the leading positions, the rest of the row start, 
+                # the value and the line break, interleaved in a single list to be joined.
+                lines = [None] * (4 * n_rows)
+                lines[1::4] = rows
+                lines[3::4] = ["\n"] * n_rows
+                for k, leading in enumerate(product(*strings[:split])):
+                    lines[0::4] = ["".join(leading)] * n_rows
+                    lines[2::4] = map(str, values[k*n_rows:(k+1)*n_rows].tolist())
+                    f.write("".join(lines))
+
+    @property
+    def n_steps(self):
+        """Get the total number of steps in the scan.
+
+        Returns
+        -------
+        int
+            The product of the number of steps along each axis.
+        """
+        return int(np.prod(self._steps))
+
+    def position_at(self, I : int):
+        """Get the output index and position visited at step `I` of the scan,
+           taking snaking into account. This is computed directly from the step
+           number, so random access to any step is O(1) in the size of the scan.
+
+        Parameters
+        ----------
+        I : int
+            The step number, must satisfy 0 <= I < n_steps.
+
+        Returns
+        -------
+        tuple[int]
+            The index along each positive position [xmin,...,xmax] array.
+        tuple[Number]
+            The position along each axis.
+        """
+        if not (0 <= I < self.n_steps):
+            raise IndexError(f"Step {I} outside of scan with {self.n_steps} steps.")
+        index = _scan_index(I, self._steps, self._snake)
+        position = tuple(self._positions[ax][idx] for ax, idx in enumerate(index))
+        return index, position
+
+    def scan_positions(self, start : int = 0):
+        """Lazily iterate over the scan, yielding the step number, output index
+           and position of every step in the order they are visited.
+           Unlike `generate_scan_positions`, nothing is precomputed, so the
+           memory used is constant regardless of the size of the scan.
+           The index is advanced from one step to the next like an odometer,
+           only the starting step is computed from its step number.
+
+        Parameters
+        ----------
+        start : int, optional
+            The step number to start iterating from, by default 0
+
+        Yields
+        ------
+        I : int
+            The current step number.
+        index : tuple[int]
+            The index along each positive position [xmin,...,xmax] array.
+        position : tuple[Number]
+            The position along each axis.
+        """
+        steps = [int(n) for n in self._steps]
+        snaked = [ax in self._snake for ax in range(len(steps))]
+        # How far along its current pass each axis is, and which way that pass goes.
+        counter = []
+        forward = []
+        stride = 1
+        for ax in reversed(range(len(steps))):
+            k = start // stride
+            counter.append(k % steps[ax])
+            forward.append(not (snaked[ax] and (k // steps[ax]) % 2))
+            stride *= steps[ax]
+        counter.reverse()
+        forward.reverse()
+        index = [c if f else n - 1 - c for c, f, n in zip(counter, forward, steps)]
+        position = [self._positions[ax][idx] for ax, idx in enumerate(index)]
+
+        for I in range(start, self.n_steps):
+            yield I, tuple(index), tuple(position)
+            for ax in reversed(range(len(steps))):
+                counter[ax] += 1
+                wrapped = counter[ax] == steps[ax]
+                if wrapped:
+                    # Snaked axes turn around, staying on the same index.
+                    counter[ax] = 0
+                    forward[ax] ^= snaked[ax]
+                idx = counter[ax] if forward[ax] else steps[ax] - 1 - counter[ax]
+                index[ax] = idx
+                position[ax] = self._positions[ax][idx]
+                if not wrapped:
+                    break
 
     def generate_scan_positions(self):
         """Generate the full set of scan positions for the scanner, as well
            as the indices of the output array that correspond to the positions.
 
-           TODO: While this works as is, it's not super memory efficient.
-           This can probably be handled by a smart iterator.
+           This materializes every position of the scan at once, prefer
+           `scan_positions` or `position_at` for large scans.
         Returns
         -------
         list[np.ndarray[Number]]
@@ -583,6 +1362,108 @@ class Scanner():
 
         return positions, indices
     
+def _sweep(loop : Callable, results : npt.NDArray, init : Callable, finish : Callable,
+           cleanup : Callable = None):
+    """Run a scan, in the same way for every kind of scanner. Runs the init function, then
+       `loop`, which visits every point and returns whether the scan completed and whether
+       the abort function stopped it, then unless aborted, the finish function.
+       A KeyboardInterrupt stops the scan as incomplete, and `cleanup` is run whenever
+       the loop stops, even on an error.
+
+    Returns
+    -------
+    np.ndarray[npt.DTypeLike]
+        The results array.
+    """
+    init()
+    completed = False
+    aborted = False
+    try:
+        completed, aborted = loop()
+    except KeyboardInterrupt:
+        warn("Caught Keyboard Intterup, aborting scan.")
+    finally:
+        if cleanup is not None:
+            cleanup()
+
+    if aborted:
+        return results
+    finish(results, completed)
+
+    return results
+
+def _run_async(run : Callable):
+    """Call `run` in a new thread, see `Scanner.run_async`."""
+    t = Thread(target=run)
+    t.start()
+    return t
+
+def _timed(function : Callable, *args):
+    """Run a function, returning its output and how long it took in seconds."""
+    start = perf_counter()
+    result = function(*args)
+    return result, perf_counter() - start
+
+def _measured_steps(points : list[tuple]):
+    """The step numbers of the measured steps covered by an acquisition."""
+    return [I for I, _, _, measured in points if measured]
+
+def _check_n_params(function : Callable, n_params : int, msg : str):
+    """Check that a function takes `n_params` parameters, or an arbitrary
+       number of parameters through *args.
+
+    Parameters
+    ----------
+    function : Callable
+        The function to check.
+    n_params : int
+        The number of parameters it should take.
+    msg : str
+        The message of the error raised if it doesn't.
+    """
+    if len(signature(function).parameters) != n_params:
+        try:
+            if list(signature(function).parameters.values())[0].kind != 2:
+                raise RuntimeError(msg)
+        except IndexError:
+            raise RuntimeError(msg)
+
+def _scan_index(I, steps, snake):
+    """Compute the index along each axis visited at step `I` of a scan.
+       The last axis is the fastest, and every axis in `snake` reverses its
+       direction on every other pass. Works both on a single step number
+       and on an integer array of step numbers.
+
+    Parameters
+    ----------
+    I : int | numpy.ndarray[int]
+        The step number(s).
+    steps : list[int]
+        The number of steps along each axis.
+    snake : list[int]
+        Which axes are snaked.
+
+    Returns
+    -------
+    tuple[int] | tuple[numpy.ndarray[int]]
+        The index along each axis.
+    """
+    index = []
+    stride = 1
+    for ax in reversed(range(len(steps))):
+        n = int(steps[ax])
+        k = I // stride
+        idx = k % n
+        if ax in snake:
+            flip = (k // n) % 2 == 1
+            if isinstance(idx, np.ndarray):
+                idx = np.where(flip, n - 1 - idx, idx)
+            elif flip:
+                idx = n - 1 - idx
+        index.append(idx)
+        stride *= n
+    return tuple(reversed(index))
+
 def _safe_file_name(filename : Path):
     """Check the file path for a file with the same name, if one is found
        append a number to the given filename to avoid conflicts.